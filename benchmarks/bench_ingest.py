@@ -0,0 +1,99 @@
+# Benchmark: ingest throughput with 1..N catch-all mailboxes, each fetched by its own worker.
+#
+# Mail is spread over one domain per mailbox and served by the fake IMAP server, with a per-message
+# delay standing in for a provider's per-mailbox download rate.
+#
+#   python benchmarks/bench_ingest.py --messages 4000 --mailboxes 1 2 4 --message-latency 0.002
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import import_main, make_message
+from fake_imap import FakeImapServer
+
+class CountingDispatcher:
+    """Stands in for the notification dispatcher and counts the emails that reach it."""
+
+    def __init__(self):
+        self.delivered = 0
+        self.done = asyncio.Event()
+        self.expected = 0
+
+    async def put(self, new_email):
+        self.delivered += 1
+        if self.delivered >= self.expected:
+            self.done.set()
+
+    def stats(self):
+        return {'sent': self.delivered, 'messages': self.delivered, 'failed': 0, 'retried': 0, 'pending': 0, 'queue_depth': 0}
+
+async def run_case(main, mailboxes, args, offset):
+    users = [f'box{k}@bench.example' for k in range(mailboxes)]
+    # A fresh UIDVALIDITY per case, so checkpoints left by the previous case do not apply
+    server = FakeImapServer({user: 'bench' for user in users}, latency=args.latency,
+                            message_latency=args.message_latency, uidvalidity=offset + 1).start()
+    for i in range(args.messages):
+        k = i % mailboxes
+        # Message-IDs stay unique across cases, so the dedup window does not drop them
+        server.deliver(users[k], make_message(offset + i, f'user{i % args.addresses}@{main.EMAIL_DOMAINS[k]}',
+                                              body_words=args.body_words, html=False))
+
+    dispatcher = CountingDispatcher()
+    dispatcher.expected = args.messages
+    pipeline = main.IngestPipeline(dispatcher)
+    pipeline.start()
+    sessions = [main.ImapSession('127.0.0.1', user, 'bench', port=server.port, ssl=False) for user in users]
+    started = time.perf_counter()
+    workers = [asyncio.create_task(main.background_tasks_loop(pipeline, session)) for session in sessions]
+    await asyncio.wait_for(dispatcher.done.wait(), timeout=600)
+    elapsed = time.perf_counter() - started
+
+    for worker in workers:
+        worker.cancel()
+    for session in sessions:
+        session.stop()
+        await session.run(session.close)
+    pipeline.close()
+    server.stop()
+    return elapsed, server.commands
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark sharded ingest over several IMAP mailboxes.')
+    parser.add_argument('--messages', type=int, default=4000)
+    parser.add_argument('--mailboxes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--addresses', type=int, default=200, help='recipient addresses per domain')
+    parser.add_argument('--body-words', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds per IMAP reply')
+    parser.add_argument('--message-latency', type=float, default=0.002, help='seconds per fetched message')
+    args = parser.parse_args()
+
+    domains = [f'd{k}.bench.example' for k in range(max(args.mailboxes))]
+    # Set before import so the parser processes accept every domain too
+    os.environ['EMAIL_DOMAINS'] = ','.join(domains)
+    with tempfile.TemporaryDirectory() as tmp:
+        main = import_main(os.path.join(tmp, 'bench.db'))
+        main.init_db()
+
+        async def run():
+            main.db.start()
+            def create_addresses(conn):
+                for domain in domains:
+                    for i in range(args.addresses):
+                        full_address = f'user{i}@{domain}'
+                        address_id = conn.execute(main.QUERIES['insert_address'], (i, full_address, time.strftime('%Y-%m-%d'))).lastrowid
+                        main.address_router.add(full_address, address_id, i)
+            await main.db.write(create_addresses)
+
+            print(f"{'mailboxes':>9}{'seconds':>10}{'msg/s':>10}{'IMAP cmds':>11}")
+            for n, mailboxes in enumerate(args.mailboxes):
+                elapsed, commands = await run_case(main, mailboxes, args, n * args.messages)
+                print(f"{mailboxes:>9}{elapsed:>10.2f}{args.messages / elapsed:>10.1f}{commands:>11}")
+            main.db.close()
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,85 @@
+# Benchmark: MIME parsing on the event-loop thread vs. the parser process pool.
+#
+#   python benchmarks/bench_parse.py --messages 2000 --attachment-kb 256 --processes 4
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from common import import_main, write_corpus
+
+async def parse_all(main, executor, raws, concurrency):
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    async def parse_one(raw):
+        async with semaphore:
+            return await loop.run_in_executor(executor, main.parse_raw_email, raw)
+    return await asyncio.gather(*(parse_one(raw) for raw in raws))
+
+async def loop_stall(interval=0.01):
+    """Measures the worst event-loop stall while parsing runs, i.e. how unresponsive handlers would be."""
+    worst = 0.0
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        worst = max(worst, time.perf_counter() - started - interval)
+        loop_stall.worst = worst
+
+async def run_case(main, raws, executor, concurrency):
+    loop_stall.worst = 0.0
+    probe = asyncio.create_task(loop_stall())
+    await asyncio.sleep(0.02)  # let the probe start ticking
+    started = time.perf_counter()
+    if executor == 'inline':
+        results = [main.parse_raw_email(raw) for raw in raws]
+    else:
+        results = await parse_all(main, executor, raws, concurrency)
+    elapsed = time.perf_counter() - started
+    await asyncio.sleep(0.02)  # let the probe observe a stall that just ended
+    probe.cancel()
+    return elapsed, loop_stall.worst, sum(1 for r in results if r)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark MIME parsing strategies.')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--body-words', type=int, default=500)
+    parser.add_argument('--attachment-kb', type=int, default=128)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--corpus', help='directory of .eml files to use instead of a generated corpus')
+    args = parser.parse_args()
+
+    main = import_main()
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.corpus:
+            paths = sorted(os.path.join(args.corpus, name) for name in os.listdir(args.corpus) if name.endswith('.eml'))
+        else:
+            paths = write_corpus(tmp, args.messages, [f'user{i}@{main.EMAIL_DOMAIN}' for i in range(50)],
+                                 body_words=args.body_words, attachment_kb=args.attachment_kb)
+        raws = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                raws.append(f.read())
+
+    total_mb = sum(map(len, raws)) / (1024 * 1024)
+    print(f"Corpus: {len(raws)} messages, {total_mb:.1f} MB")
+
+    async def run():
+        cases = [('inline (event loop)', 'inline'), ('thread pool', None)]
+        pool = main.create_parse_executor(args.processes)
+        if pool:
+            # Warm the workers up so process start-up is not counted
+            await parse_all(main, pool, raws[:args.processes], args.processes)
+            cases.append((f'process pool x{args.processes}', pool))
+        for label, executor in cases:
+            elapsed, stall, parsed = await run_case(main, raws, executor, max(args.processes * 2, 4))
+            print(f"{label:<22} {len(raws) / elapsed:9.1f} msg/s  {total_mb / elapsed:7.1f} MB/s  "
+                  f"worst loop stall {stall * 1000:8.1f} ms  parsed {parsed}")
+        if pool:
+            pool.shutdown()
+
+    asyncio.run(run())
+
+if __name__ == '__main__':
+    main_cli()
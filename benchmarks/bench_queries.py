@@ -0,0 +1,81 @@
+# Benchmark: hot-path query latency with and without the migration-2 indexes.
+#
+#   python benchmarks/bench_queries.py --addresses 1000000 --users 50000
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+from common import import_main
+
+# The per-click admin aggregates the bot ran before the migration-7 counters replaced them
+ADMIN_AGGREGATES = {
+    'admin_totals': "SELECT COUNT(DISTINCT user_id), COUNT(*) FROM addresses",
+    'admin_users': "SELECT user_id, COUNT(id) FROM addresses GROUP BY user_id ORDER BY COUNT(id) DESC",
+}
+
+def populate(main, conn, addresses, users, seed=1):
+    rng = random.Random(seed)
+    today = date.today()
+    rows = ((rng.randrange(users), f'user{i}@{main.EMAIL_DOMAIN}', today - timedelta(days=rng.randrange(30)))
+            for i in range(addresses))
+    conn.executemany(main.QUERIES['insert_address'], rows)
+    conn.commit()
+
+def time_query(conn, sql, param_sets):
+    latencies = []
+    for params in param_sets:
+        started = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return statistics.median(latencies), latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+def run_suite(main, conn, users, repeat, rng):
+    today = date.today()
+    cases = {
+        'daily_address_count': [(rng.randrange(users), today) for _ in range(repeat)],
+        'user_addresses': [(rng.randrange(users),) for _ in range(repeat)],
+        # Whole-table aggregates are slow either way; a few runs are enough
+        'admin_totals': [()] * min(repeat, 5),
+        'admin_users': [()] * min(repeat, 5),
+    }
+    return {name: time_query(conn, main.QUERIES.get(name) or ADMIN_AGGREGATES[name], params) for name, params in cases.items()}
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark address queries before and after the index migration.')
+    parser.add_argument('--addresses', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--repeat', type=int, default=200, help='executions per point query')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main = import_main(os.path.join(tmp, 'bench.db'))
+        conn = main.get_db_conn()
+        main.apply_migrations(conn, target=1)
+        started = time.perf_counter()
+        populate(main, conn, args.addresses, args.users)
+        print(f"Inserted {args.addresses} addresses for {args.users} users in {time.perf_counter() - started:.1f}s")
+
+        before = run_suite(main, conn, args.users, args.repeat, random.Random(2))
+        started = time.perf_counter()
+        main.apply_migrations(conn)
+        conn.execute("ANALYZE")
+        print(f"Applied index migrations in {time.perf_counter() - started:.1f}s")
+        after = run_suite(main, conn, args.users, args.repeat, random.Random(2))
+
+        print(f"\n{'query':<26}{'p50 before':>12}{'p99 before':>12}{'p50 after':>12}{'p99 after':>12}   plan after")
+        for name in before:
+            plan = '; '.join(main.explain_query(conn, main.QUERIES.get(name) or ADMIN_AGGREGATES[name]))
+            cells = [before[name][0], before[name][1], after[name][0], after[name][1]]
+            print(f"{name:<26}" + ''.join(f"{value * 1000:>10.3f}ms" for value in cells) + f"   {plan}")
+        unindexed = main.check_query_plans(conn)
+        print(f"\nFull table scans remaining: {unindexed or 'none'}")
+        conn.close()
+
+if __name__ == '__main__':
+    main_cli()
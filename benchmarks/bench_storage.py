@@ -0,0 +1,82 @@
+# Benchmark: database size and metadata-scan latency with inline TEXT bodies vs. compressed email_bodies.
+#
+#   python benchmarks/bench_storage.py --emails 50000 --body-words 400
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from common import import_main, random_text
+
+METADATA_SCAN = "SELECT COUNT(*), SUM(LENGTH(subject)), MAX(received_at) FROM emails"
+ADDRESS_LISTING = "SELECT id, from_address, subject, received_at FROM emails WHERE address_id = ? ORDER BY received_at DESC"
+
+def db_size(main, conn):
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    return os.path.getsize(main.DB_PATH)
+
+def timed(fn, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - started)
+    return statistics.median(latencies)
+
+def measure(main, conn, addresses, repeat, rng, body_query):
+    email_ids = [row[0] for row in conn.execute("SELECT id FROM emails ORDER BY RANDOM() LIMIT ?", (repeat,))]
+    address_ids = [rng.randrange(1, addresses + 1) for _ in range(repeat)]
+    return {
+        'size_mb': db_size(main, conn) / (1024 * 1024),
+        'scan_ms': timed(lambda: conn.execute(METADATA_SCAN).fetchall(), min(repeat, 20)) * 1000,
+        'listing_ms': timed(lambda: conn.execute(ADDRESS_LISTING, (address_ids.pop(),)).fetchall(), repeat) * 1000,
+        'view_ms': timed(lambda: main.decode_body(conn.execute(body_query, (email_ids.pop(),)).fetchone()[0]), repeat) * 1000,
+    }
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Benchmark inline vs. compressed email body storage.')
+    parser.add_argument('--emails', type=int, default=50_000)
+    parser.add_argument('--addresses', type=int, default=2_000)
+    parser.add_argument('--body-words', type=int, default=400)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        main = import_main(os.path.join(tmp, 'bench.db'))
+        conn = main.get_db_conn()
+        # Schema as it was before compressed storage: bodies inline in emails.body
+        main.apply_migrations(conn, target=4)
+        rng = random.Random(1)
+        conn.executemany(main.QUERIES['insert_address'],
+                         ((i, f'user{i}@{main.EMAIL_DOMAIN}', datetime.now().date()) for i in range(args.addresses)))
+        now = datetime.now()
+        # Mail bodies repeat a lot (quoted replies, footers); draw from a shared vocabulary like real text
+        paragraphs = [random_text(rng, 40) for _ in range(200)]
+        conn.executemany(
+            "INSERT INTO emails (address_id, message_id, from_address, subject, body, received_at) VALUES (?, ?, ?, ?, ?, ?)",
+            ((rng.randrange(1, args.addresses + 1), f'<{i}@bench>', f'sender{i}@example.org', f'Subject {i}',
+              '\n\n'.join(rng.choices(paragraphs, k=max(1, args.body_words // 40))), now - timedelta(seconds=i))
+             for i in range(args.emails)))
+        conn.commit()
+
+        before = measure(main, conn, args.addresses, args.repeat, random.Random(2), "SELECT body FROM emails WHERE id = ?")
+        started = time.perf_counter()
+        main.apply_migrations(conn)
+        conn.execute("VACUUM")
+        print(f"Migrated {args.emails} bodies to compressed storage in {time.perf_counter() - started:.1f}s\n")
+        after = measure(main, conn, args.addresses, args.repeat, random.Random(2),
+                        "SELECT body FROM email_bodies WHERE email_id = ?")
+
+        print(f"{'':<24}{'inline TEXT':>14}{'compressed':>14}")
+        labels = {'size_mb': 'DB size (MB)', 'scan_ms': 'metadata scan p50 (ms)',
+                  'listing_ms': 'address listing p50 (ms)', 'view_ms': 'body view p50 (ms)'}
+        for key, label in labels.items():
+            print(f"{label:<24}{before[key]:>14.3f}{after[key]:>14.3f}")
+        conn.close()
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,106 @@
+# Shared helpers for the benchmark scripts: importing the bot module offline and building synthetic mail.
+
+import os
+import sys
+import json
+import time
+import random
+import string
+from collections import Counter
+from email.message import EmailMessage
+
+from telegram.request import BaseRequest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BENCH_ENV = {
+    'BOT_TOKEN': '123456:bench-token',
+    'EMAIL_DOMAIN': 'bench.example',
+    'APP_HOST_DOMAIN': 'localhost',
+    'CATCH_ALL_EMAIL': 'catchall@bench.example',
+    'CATCH_ALL_PASSWORD': 'bench',
+}
+
+def import_main(db_path=None):
+    """Imports main.py with placeholder credentials so it can be driven without Telegram or Gmail."""
+    for key, value in BENCH_ENV.items():
+        os.environ.setdefault(key, value)
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import main
+    if db_path:
+        main.DB_PATH = db_path
+    return main
+
+def random_text(rng, words):
+    return ' '.join(''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))) for _ in range(words))
+
+def make_message(i, to_address, rng=None, body_words=300, attachment_kb=0, html=True):
+    """Builds one synthetic RFC 822 message as bytes."""
+    rng = rng or random.Random(i)
+    msg = EmailMessage()
+    msg['Message-ID'] = f'<bench-{i}@bench.example>'
+    msg['To'] = to_address
+    msg['From'] = f'Sender {i} <sender{i}@example.org>'
+    msg['Subject'] = f'Benchmark message {i}: {random_text(rng, 5)}'
+    text = random_text(rng, body_words)
+    msg.set_content(text)
+    if html:
+        msg.add_alternative(f'<html><body><p>{text}</p></body></html>', subtype='html')
+    if attachment_kb:
+        msg.add_attachment(rng.randbytes(attachment_kb * 1024), maintype='application', subtype='octet-stream', filename=f'file{i}.bin')
+    return msg.as_bytes()
+
+def write_corpus(directory, count, to_addresses, **kwargs):
+    """Writes `count` synthetic .eml files to `directory` and returns their paths."""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f'{i:06d}.eml')
+        with open(path, 'wb') as f:
+            f.write(make_message(i, to_addresses[i % len(to_addresses)], **kwargs))
+        paths.append(path)
+    return paths
+
+def make_command_update(update_id, user_id, command):
+    """Builds the JSON Telegram sends for a private-chat bot command."""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'},
+            'text': command,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command.split()[0])}],
+        },
+    }
+
+class FakeBotRequest(BaseRequest):
+    """Answers every Bot API call locally, so handlers can run at full speed without Telegram."""
+
+    def __init__(self):
+        self.calls = Counter()
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        params = request_data.parameters if request_data else {}
+        if api_method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif api_method in ('sendMessage', 'editMessageText'):
+            result = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': params.get('chat_id', 1), 'type': 'private'}}
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
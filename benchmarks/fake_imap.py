@@ -0,0 +1,297 @@
+# A small in-process IMAP server for running the ingest workers offline.
+#
+# Speaks the subset of IMAP4rev1 the bot uses (LOGIN, SELECT, CAPABILITY with IDLE, UID SEARCH,
+# UID FETCH, UID STORE, NOOP, IDLE, LOGOUT) over plain TCP, so ImapSession connects with ssl=False.
+# Mail is delivered with FakeImapServer.deliver(). Like a real server, new mail is announced with
+# "* n EXISTS" in the reply to whatever command comes next, or right away to an idling client.
+#
+# Standalone, seeded with a synthetic corpus:
+#   python benchmarks/fake_imap.py --port 1143 --user catchall@bench.example --messages 500
+# then run the bot with IMAP_ACCOUNTS='[{"user": "catchall@bench.example", "password": "bench",
+#   "host": "127.0.0.1", "port": 1143, "ssl": false}]'
+
+import argparse
+import re
+import select
+import socket
+import socketserver
+import threading
+import time
+
+TOKEN = re.compile(rb'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+class FakeMailbox:
+    """Messages of one account as {uid: [raw bytes, flags]}; UIDs only grow, nothing is expunged."""
+
+    def __init__(self, uidvalidity):
+        self.uidvalidity = uidvalidity
+        self.next_uid = 1
+        self.messages = {}
+        self.changed = threading.Condition()
+
+    def add(self, raw):
+        with self.changed:
+            uid = self.next_uid
+            self.next_uid += 1
+            self.messages[uid] = [raw, set()]
+            self.changed.notify_all()
+            return uid
+
+    def uids(self):
+        with self.changed:
+            return list(self.messages)
+
+    def parse_uid_set(self, uid_set):
+        """Expands "1,4:7,9:*" into the UIDs that exist; "*" is the highest UID, and a:b equals b:a."""
+        existing = self.uids()
+        highest = existing[-1] if existing else 0
+        wanted = set()
+        for part in uid_set.split(','):
+            low, _, high = part.partition(':')
+            low = highest if low == '*' else int(low)
+            high = low if not high else highest if high == '*' else int(high)
+            low, high = min(low, high), max(low, high)
+            wanted.update(uid for uid in existing if low <= uid <= high)
+        return sorted(wanted)
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    """Threaded IMAP server holding mailboxes in memory.
+
+    `latency` delays every reply like a remote server's round trip; `message_latency` is added per
+    message returned by FETCH, like a mailbox whose download rate is throttled.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, accounts, host='127.0.0.1', port=0, idle=True, latency=0.0, message_latency=0.0, uidvalidity=1):
+        super().__init__((host, port), ImapHandler)
+        self.accounts = dict(accounts) # user -> password
+        self.mailboxes = {user: FakeMailbox(uidvalidity) for user in self.accounts}
+        self.idle = idle
+        self.latency = latency
+        self.message_latency = message_latency
+        self.commands = 0
+        self._thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def deliver(self, user, raw):
+        """Appends a raw message to a user's INBOX and returns its UID."""
+        return self.mailboxes[user].add(raw)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-imap', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+class ImapHandler(socketserver.BaseRequestHandler):
+    """One client connection. Reads lines off the raw socket, so IDLE can select() on it."""
+
+    def setup(self):
+        self.buffer = b''
+        self.user = self.mailbox = None
+        self.reported = 0 # message count last announced to this client
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) # Replies are small and latency-bound
+
+    def send(self, *lines):
+        self.request.sendall(b''.join(line if isinstance(line, bytes) else line.encode() + b'\r\n' for line in lines))
+
+    def readline(self, timeout=None):
+        """Returns the next line without CRLF, None on timeout, or b'' once the client hangs up."""
+        while b'\r\n' not in self.buffer:
+            ready, _, _ = select.select([self.request], [], [], timeout)
+            if not ready:
+                return None
+            chunk = self.request.recv(65536)
+            if not chunk:
+                return b''
+            self.buffer += chunk
+        line, self.buffer = self.buffer.split(b'\r\n', 1)
+        return line
+
+    def handle(self):
+        capabilities = 'IMAP4rev1 IDLE' if self.server.idle else 'IMAP4rev1'
+        self.send(f'* OK [CAPABILITY {capabilities}] Fake IMAP ready')
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            tokens = [(match[1] if match[1] is not None else match[2]).decode() for match in TOKEN.finditer(line)]
+            if len(tokens) < 2:
+                self.send('* BAD Missing command')
+                continue
+            tag, command, args = tokens[0], tokens[1].upper(), tokens[2:]
+            self.server.commands += 1
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            if command != 'IDLE': # IDLE announces new mail right after its continuation
+                self.report_exists()
+            handler = getattr(self, f'do_{command}', None)
+            if handler is None:
+                self.send(f'{tag} BAD Unknown command {command}')
+                continue
+            try:
+                if handler(tag, args) is False:
+                    return
+            except (ValueError, IndexError, KeyError) as e:
+                self.send(f'{tag} BAD {e!r}')
+
+    def exists_update(self):
+        """Returns "* n EXISTS" for messages delivered since the client last heard the count, or None."""
+        if self.mailbox is None:
+            return None
+        count = len(self.mailbox.uids())
+        if count == self.reported:
+            return None
+        self.reported = count
+        return f'* {count} EXISTS'
+
+    def report_exists(self):
+        update = self.exists_update()
+        if update:
+            self.send(update)
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(f"* CAPABILITY {'IMAP4rev1 IDLE' if self.server.idle else 'IMAP4rev1'}", f'{tag} OK CAPABILITY completed')
+
+    def do_LOGIN(self, tag, args):
+        user, password = args
+        if self.server.accounts.get(user) != password:
+            self.send(f'{tag} NO [AUTHENTICATIONFAILED] Invalid credentials')
+            return
+        self.user = user
+        self.send(f'{tag} OK LOGIN completed')
+
+    def do_SELECT(self, tag, args):
+        self.mailbox = self.server.mailboxes[self.user]
+        self.reported = len(self.mailbox.uids())
+        self.send(f'* {self.reported} EXISTS', '* 0 RECENT', '* FLAGS (\\Seen)',
+                  f'* OK [UIDVALIDITY {self.mailbox.uidvalidity}] UIDs valid',
+                  f'* OK [UIDNEXT {self.mailbox.next_uid}] Predicted next UID',
+                  f'{tag} OK [READ-WRITE] SELECT completed')
+
+    do_EXAMINE = do_SELECT
+
+    def do_NOOP(self, tag, args):
+        self.send(f'{tag} OK NOOP completed')
+
+    def do_LOGOUT(self, tag, args):
+        self.send('* BYE Logging out', f'{tag} OK LOGOUT completed')
+        return False
+
+    def do_UID(self, tag, args):
+        command, args = args[0].upper(), args[1:]
+        if command == 'SEARCH':
+            self.uid_search(tag, args)
+        elif command == 'FETCH':
+            self.uid_fetch(tag, args)
+        elif command == 'STORE':
+            self.uid_store(tag, args)
+        else:
+            self.send(f'{tag} BAD Unsupported UID {command}')
+
+    def uid_search(self, tag, args):
+        criteria = ' '.join(args).strip('()').split()
+        uids = self.mailbox.uids()
+        while criteria:
+            key = criteria.pop(0).upper()
+            if key == 'UID':
+                wanted = set(self.mailbox.parse_uid_set(criteria.pop(0)))
+                uids = [uid for uid in uids if uid in wanted]
+            elif key in ('UNSEEN', 'SEEN'):
+                uids = [uid for uid in uids if ('\\Seen' in self.mailbox.messages[uid][1]) == (key == 'SEEN')]
+            elif key != 'ALL':
+                raise ValueError(f'unsupported search key {key}')
+        self.send(f"* SEARCH {' '.join(map(str, uids))}".rstrip(), f'{tag} OK SEARCH completed')
+
+    def uid_fetch(self, tag, args):
+        uids = self.mailbox.parse_uid_set(args[0])
+        items = ' '.join(args[1:]).upper()
+        peek = 'BODY.PEEK[]' in items
+        if self.server.message_latency:
+            time.sleep(self.server.message_latency * len(uids))
+        out = []
+        for uid in uids:
+            raw, flags = self.mailbox.messages[uid]
+            if not peek:
+                flags.add('\\Seen')
+            # Nothing is ever expunged, so a message's sequence number equals its UID
+            out.append(f'* {uid} FETCH (UID {uid} BODY[] {{{len(raw)}}}\r\n'.encode() + raw + b')\r\n')
+        self.send(*out, f'{tag} OK FETCH completed')
+
+    def uid_store(self, tag, args):
+        uids = self.mailbox.parse_uid_set(args[0])
+        mode = args[1].upper()
+        flags = set(' '.join(args[2:]).strip('()').split())
+        for uid in uids:
+            current = self.mailbox.messages[uid][1]
+            if mode.startswith('-'):
+                current -= flags
+            elif mode.startswith('+'):
+                current |= flags
+            else:
+                current.clear()
+                current |= flags
+        self.send(f'{tag} OK STORE completed')
+
+    def do_IDLE(self, tag, args):
+        if not self.server.idle:
+            self.send(f'{tag} BAD IDLE not supported')
+            return
+        # Mail delivered since the last reply goes out in the same segment as the continuation, as
+        # real servers often do, so a client watching only the socket would miss it
+        update = self.exists_update()
+        self.send('+ idling', *([update] if update else []))
+        while True:
+            with self.mailbox.changed:
+                self.mailbox.changed.wait_for(lambda: len(self.mailbox.messages) != self.reported, timeout=0.05)
+            self.report_exists()
+            line = self.readline(timeout=0)
+            if line == b'':
+                return False
+            if line is not None:
+                if line.strip().upper() != b'DONE':
+                    self.send(f'{tag} BAD Expected DONE')
+                    return
+                self.send(f'{tag} OK IDLE terminated')
+                return
+
+def main_cli():
+    from common import make_message
+
+    parser = argparse.ArgumentParser(description='Run a fake IMAP server seeded with synthetic mail.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--user', action='append', help='account address (repeatable); password is --password')
+    parser.add_argument('--password', default='bench')
+    parser.add_argument('--messages', type=int, default=100, help='synthetic messages seeded per account')
+    parser.add_argument('--to', default='user{i}@bench.example', help='recipient pattern; {i} is replaced by i %% 50')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every reply')
+    args = parser.parse_args()
+
+    users = args.user or ['catchall@bench.example']
+    server = FakeImapServer({user: args.password for user in users}, args.host, args.port, latency=args.latency)
+    for n, user in enumerate(users):
+        for i in range(n * args.messages, (n + 1) * args.messages):
+            server.deliver(user, make_message(i, args.to.format(i=i % 50), html=False))
+    print(f"Fake IMAP on {args.host}:{server.port} with {len(users)} accounts x {args.messages} messages; Ctrl+C stops")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,113 @@
+# A stub Telegram Bot API server for load tests: point TELEGRAM_API_URL at it.
+#
+# Answers every method with a plausible result and records each sendMessage, so a test can tell
+# when a notification reached "Telegram". Can also add latency and answer some sends with a
+# 429 flood-wait, to exercise the dispatcher's rate limiting.
+
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+class FakeBotApiServer(ThreadingHTTPServer):
+    """Threaded HTTP server speaking enough of the Bot API for the bot's handlers and dispatcher."""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, flood_every=0, retry_after=1, on_message=None):
+        super().__init__((host, port), BotApiHandler)
+        self.latency = latency
+        self.flood_every = flood_every
+        self.retry_after = retry_after
+        self.on_message = on_message # called with (chat_id, text, reply_markup, monotonic time) per sendMessage
+        self.calls = Counter()
+        self.floods = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-telegram', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def count(self, method):
+        """Counts a call and returns True when this one should be refused with a flood-wait."""
+        with self._lock:
+            self.calls[method] += 1
+            if self.flood_every and method == 'sendMessage' and self.calls[method] % self.flood_every == 0:
+                self.floods += 1
+                return True
+        return False
+
+class BotApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive, like the real API
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        match = re.fullmatch(r'/bot[^/]+/(\w+)', self.path)
+        if not match:
+            self.reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+            return
+        method = match[1]
+        length = int(self.headers.get('Content-Length') or 0)
+        params = self.parse_params(self.rfile.read(length))
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.count(method):
+            self.reply(429, {'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.server.retry_after}',
+                             'parameters': {'retry_after': self.server.retry_after}})
+            return
+
+        chat = {'id': int(params.get('chat_id', 1)), 'type': 'private'}
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'Load test', 'username': 'loadtest_bot'}
+        elif method == 'getUpdates':
+            # No updates ever arrive by polling; a short long-poll keeps a polling bot from spinning
+            time.sleep(min(float(params.get('timeout') or 0), 0.5))
+            result = []
+        elif method in ('sendMessage', 'editMessageText'):
+            result = {'message_id': 1, 'date': int(time.time()), 'chat': chat, 'text': params.get('text', '')}
+            if method == 'sendMessage' and self.server.on_message:
+                self.server.on_message(chat['id'], params.get('text', ''), params.get('reply_markup'), time.monotonic())
+        else:
+            result = True
+        self.reply(200, {'ok': True, 'result': result})
+
+    def parse_params(self, body):
+        """Decodes JSON or form parameters; form values that hold JSON (reply_markup) are decoded too."""
+        if not body:
+            return {}
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            return json.loads(body)
+        params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        if 'reply_markup' in params:
+            params['reply_markup'] = json.loads(params['reply_markup'])
+        return params
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
@@ -0,0 +1,380 @@
+# End-to-end load test: fake IMAP mailboxes -> the bot (webhook mode, ASGI web tier) -> stub Bot API.
+#
+# Synthetic users create an address each with /new. Mail for them then arrives in the fake
+# mailboxes at a fixed rate, while the users keep sending commands and opening /view_email pages.
+# Everything runs in this process except the parser pool, through the same code paths as production:
+# IMAP IDLE, the ingest pipeline, the notification dispatcher, the webhook and the Flask views.
+# The fake servers and load drivers share the bot's GIL, so treat absolute numbers as a lower bound
+# and compare runs made on the same machine.
+#
+# Reports ingest throughput, p50/p99 delivery latency (mail arrival -> sendMessage reaching the
+# stub), command and page latencies, and peak RSS of the bot and its parser processes.
+#
+#   python benchmarks/loadtest.py --rate 10000 --duration 60 --users 500 --mailboxes 2
+#   python benchmarks/loadtest.py --duration 20 --profile loadtest.prof --tracemalloc 15 --json results.json
+
+import argparse
+import asyncio
+import collections
+import cProfile
+import json
+import multiprocessing
+import os
+import pstats
+import random
+import re
+import resource
+import statistics
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import httpx
+
+from common import import_main, make_command_update, make_message
+from fake_imap import FakeImapServer
+from fake_telegram import FakeBotApiServer
+
+WEBHOOK_SECRET = 'loadtest-secret'
+COMMANDS = ['/myemails', '/myemails', '/start', '/new']
+NOTIFICATION = re.compile(r'Benchmark message (\d+)')
+
+def percentiles(values):
+    """Returns {p50, p99, max} of latencies in seconds, in milliseconds; zeros for an empty sample."""
+    if not values:
+        return {'p50': 0.0, 'p99': 0.0, 'max': 0.0}
+    values = sorted(values)
+    p99 = values[min(len(values) - 1, int(len(values) * 0.99))]
+    return {'p50': round(statistics.median(values) * 1000, 1), 'p99': round(p99 * 1000, 1), 'max': round(values[-1] * 1000, 1)}
+
+def rss_bytes():
+    """Resident memory of this process plus its parser processes (Linux /proc; else this process's peak)."""
+    total = 0
+    for pid in [os.getpid()] + [child.pid for child in multiprocessing.active_children()]:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                total += next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        except (OSError, StopIteration):
+            if pid == os.getpid():
+                return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return total
+
+class Tracker:
+    """Matches what the stub Bot API receives to the mail and commands that caused it.
+
+    Fed from the stub's HTTP threads, so state is guarded by a lock and waiters are woken on the loop.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.lock = threading.Lock()
+        self.arrivals = {} # message number -> monotonic time it landed in the mailbox
+        self.delivery_latencies = []
+        self.notifications = 0
+        self.email_ids = []
+        self.commands = collections.defaultdict(collections.deque) # chat_id -> send times of unanswered commands
+        self.command_latencies = []
+        self.replies = 0
+        self.changed = asyncio.Event()
+
+    def mail_arrived(self, number):
+        with self.lock:
+            self.arrivals[number] = time.monotonic()
+
+    def command_sent(self, chat_id):
+        with self.lock:
+            self.commands[chat_id].append(time.monotonic())
+
+    def on_message(self, chat_id, text, reply_markup, received):
+        numbers = NOTIFICATION.findall(text)
+        with self.lock:
+            if numbers:
+                self.notifications += 1
+                for number in map(int, numbers):
+                    arrived = self.arrivals.pop(number, None)
+                    if arrived is not None:
+                        self.delivery_latencies.append(received - arrived)
+                for row in (reply_markup or {}).get('inline_keyboard', []):
+                    self.email_ids.extend(int(button['url'].rsplit('/', 1)[1]) for button in row if 'url' in button)
+            else:
+                self.replies += 1
+                pending = self.commands.get(chat_id)
+                if pending:
+                    self.command_latencies.append(received - pending.popleft())
+        self.loop.call_soon_threadsafe(self.changed.set)
+
+    async def wait_for(self, predicate, timeout):
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), min(remaining, 1.0))
+            except asyncio.TimeoutError:
+                pass
+        return True
+
+class RssSampler:
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.peak = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+        self.peak = max(self.peak, rss_bytes())
+
+    async def _run(self):
+        while True:
+            self.peak = max(self.peak, rss_bytes())
+            await asyncio.sleep(self.interval)
+
+async def paced(rate, count, action):
+    """Calls action(i) `count` times at `rate` per second, catching up in bursts when the loop falls behind."""
+    started = time.monotonic()
+    for i in range(count):
+        delay = started + i / rate - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        action(i)
+
+class LoadTest:
+    def __init__(self, args, main, imap, stub, tracker):
+        self.args, self.main, self.imap, self.stub, self.tracker = args, main, imap, stub, tracker
+        self.rng = random.Random(args.seed)
+        self.base_url = f'http://127.0.0.1:{args.port}'
+        self.client = httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=args.concurrency))
+        self.semaphore = asyncio.Semaphore(args.concurrency)
+        self.requests = set()
+        self.post_latencies, self.view_latencies = [], []
+        self.statuses = collections.Counter()
+        self.update_id = 0
+
+    def domain_of(self, user):
+        return self.main.EMAIL_DOMAINS[user % len(self.main.EMAIL_DOMAINS)]
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.requests.add(task)
+        task.add_done_callback(self.requests.discard)
+
+    async def request(self, method, path, latencies, **kwargs):
+        async with self.semaphore:
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, self.base_url + path, **kwargs)
+                self.statuses[f'{method} {path.split("/")[1]} {response.status_code}'] += 1
+            except httpx.HTTPError as e:
+                self.statuses[f'{method} {path.split("/")[1]} {type(e).__name__}'] += 1
+            latencies.append(time.perf_counter() - started)
+
+    def send_command(self, user, command):
+        self.update_id += 1
+        self.tracker.command_sent(user)
+        self.spawn(self.request('POST', self.main.WEBHOOK_PATH, self.post_latencies,
+                                json=make_command_update(self.update_id, user, command),
+                                headers={'X-Telegram-Bot-Api-Secret-Token': WEBHOOK_SECRET}))
+
+    async def wait_until_serving(self):
+        for _ in range(100):
+            try:
+                if (await self.client.get(self.base_url + '/')).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.1)
+        raise RuntimeError('web server did not come up')
+
+    async def signup(self):
+        """Every user creates one address, spread over the domains."""
+        users = range(1, self.args.users + 1)
+        started = time.monotonic()
+        for user in users:
+            self.send_command(user, f'/new u{user}@{self.domain_of(user)}')
+        await self.tracker.wait_for(lambda: self.tracker.replies >= len(users), 120)
+        return time.monotonic() - started
+
+    async def run(self):
+        args = self.args
+        total = int(args.rate / 60 * args.duration)
+        # Build the corpus up front so generating MIME is not part of the measurement
+        corpus = []
+        for number in range(total):
+            user = self.rng.randrange(1, args.users + 1)
+            corpus.append((user, make_message(number, f'u{user}@{self.domain_of(user)}', self.rng,
+                                              body_words=args.body_words, html=args.html)))
+
+        def deliver(number):
+            user, raw = corpus[number]
+            self.tracker.mail_arrived(number)
+            self.imap.deliver(f'box{(user - 1) % args.mailboxes}@loadtest', raw)
+
+        def command(i):
+            user = self.rng.randrange(1, args.users + 1)
+            self.send_command(user, self.rng.choice(COMMANDS))
+
+        def view(i):
+            if self.tracker.email_ids:
+                email_id = self.rng.choice(self.tracker.email_ids)
+                self.spawn(self.request('GET', f'/view_email/{email_id}', self.view_latencies))
+
+        started = time.monotonic()
+        drivers = [paced(args.rate / 60, total, deliver)]
+        if args.command_rate:
+            drivers.append(paced(args.command_rate, int(args.command_rate * args.duration), command))
+        if args.view_rate:
+            drivers.append(paced(args.view_rate, int(args.view_rate * args.duration), view))
+        await asyncio.gather(*drivers)
+        offered = time.monotonic() - started
+        drained = await self.tracker.wait_for(lambda: len(self.tracker.delivery_latencies) >= total, args.drain_timeout)
+        if self.requests:
+            await asyncio.wait(set(self.requests), timeout=30)
+        return total, offered, time.monotonic() - started, drained
+
+async def run(args):
+    domains = [f'd{k}.loadtest.example' for k in range(args.mailboxes)]
+    imap = FakeImapServer({f'box{k}@loadtest': 'loadtest' for k in range(args.mailboxes)},
+                          latency=args.imap_latency).start()
+    tracker = Tracker(asyncio.get_running_loop())
+    stub = FakeBotApiServer(latency=args.api_latency, flood_every=args.flood_every, on_message=tracker.on_message).start()
+    # Set before import so the bot and its parser processes pick them up
+    os.environ.update({
+        'BOT_MODE': 'webhook', 'WEB_SERVER': 'asgi', 'PORT': str(args.port), 'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'TELEGRAM_API_URL': stub.url, 'EMAIL_DOMAINS': ','.join(domains), 'PARSE_PROCESSES': str(args.processes),
+        'IMAP_ACCOUNTS': json.dumps([{'user': f'box{k}@loadtest', 'password': 'loadtest', 'host': '127.0.0.1',
+                                      'port': imap.port, 'ssl': False} for k in range(args.mailboxes)]),
+    })
+    if args.notify_rate:
+        os.environ['NOTIFY_GLOBAL_RATE'] = str(args.notify_rate)
+    tmp = tempfile.TemporaryDirectory()
+    main = import_main(os.path.join(tmp.name, 'loadtest.db'))
+    main.init_db()
+
+    # The lifecycle run_webhook() drives, minus signal handling and registering the webhook
+    application = main.build_application()
+    await application.initialize()
+    await application.post_init(application)
+    await application.start()
+    main.attach_webhook(application, asyncio.get_running_loop())
+
+    test = LoadTest(args, main, imap, stub, tracker)
+    sampler = RssSampler()
+    sampler.start()
+    profiler = cProfile.Profile() if args.profile else None
+    try:
+        await test.wait_until_serving()
+        signup_seconds = await test.signup()
+        print(f"Signed up {args.users} users over {args.mailboxes} domains in {signup_seconds:.2f}s")
+
+        if args.tracemalloc:
+            tracemalloc.start()
+        if profiler:
+            profiler.enable()
+        total, offered, elapsed, drained = await test.run()
+        if profiler:
+            profiler.disable()
+        snapshot = tracemalloc.take_snapshot() if args.tracemalloc else None
+        traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else 0
+        tracemalloc.stop()
+        sampler.stop()
+        pipeline_stats = main.admin_stats.snapshot()['pipeline']
+    finally:
+        await test.client.aclose()
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+        imap.stop()
+        stub.stop()
+        tmp.cleanup()
+
+    delivered = len(tracker.delivery_latencies)
+    results = {
+        'mail_offered': total,
+        'mail_rate_per_min': args.rate,
+        'offered_seconds': round(offered, 2),
+        'delivered': delivered,
+        'drained': drained,
+        'throughput_per_sec': round(delivered / elapsed, 1),
+        'delivery_ms': percentiles(tracker.delivery_latencies),
+        'notification_messages': tracker.notifications,
+        'flood_waits': stub.floods,
+        'commands': len(tracker.command_latencies),
+        'webhook_post_ms': percentiles(test.post_latencies),
+        'command_reply_ms': percentiles(tracker.command_latencies),
+        'views': len(test.view_latencies),
+        'view_ms': percentiles(test.view_latencies),
+        'http_statuses': dict(test.statuses),
+        'imap_commands': imap.commands,
+        'peak_rss_mb': round(sampler.peak / (1024 * 1024), 1),
+        'peak_rss_self_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'pipeline': {stage: {key: pipeline_stats[stage][key] for key in ('processed', 'errors', 'dropped')}
+                     for stage in ('fetch', 'parse', 'write')},
+    }
+    if traced_peak:
+        results['tracemalloc_peak_mb'] = round(traced_peak / (1024 * 1024), 1)
+    return results, profiler, snapshot
+
+def print_report(results):
+    r = results
+    print(f"\nMail: {r['mail_offered']} offered at {r['mail_rate_per_min']}/min over {r['offered_seconds']}s; "
+          f"{r['delivered']} delivered{'' if r['drained'] else ' (drain timed out)'} = {r['throughput_per_sec']}/s")
+    print(f"  delivery latency   p50 {r['delivery_ms']['p50']:9.1f} ms   p99 {r['delivery_ms']['p99']:9.1f} ms   max {r['delivery_ms']['max']:9.1f} ms")
+    print(f"  notification messages {r['notification_messages']}, flood-waits {r['flood_waits']}, IMAP commands {r['imap_commands']}")
+    print(f"  pipeline {r['pipeline']}")
+    print(f"Commands: {r['commands']} answered")
+    print(f"  webhook POST       p50 {r['webhook_post_ms']['p50']:9.1f} ms   p99 {r['webhook_post_ms']['p99']:9.1f} ms")
+    print(f"  reply at stub      p50 {r['command_reply_ms']['p50']:9.1f} ms   p99 {r['command_reply_ms']['p99']:9.1f} ms")
+    print(f"Views: {r['views']}")
+    print(f"  /view_email        p50 {r['view_ms']['p50']:9.1f} ms   p99 {r['view_ms']['p99']:9.1f} ms")
+    print(f"HTTP: {r['http_statuses']}")
+    print(f"Peak RSS: {r['peak_rss_mb']} MB with parser processes, {r['peak_rss_self_mb']} MB bot process")
+    if 'tracemalloc_peak_mb' in r:
+        print(f"tracemalloc peak: {r['tracemalloc_peak_mb']} MB")
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='End-to-end load test with a fake IMAP server and a stub Bot API.')
+    parser.add_argument('--rate', type=float, default=10000, help='mail arrivals per minute')
+    parser.add_argument('--duration', type=float, default=30, help='seconds of offered load')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--mailboxes', type=int, default=2, help='catch-all mailboxes, one domain each')
+    parser.add_argument('--command-rate', type=float, default=20, help='bot commands per second during the run')
+    parser.add_argument('--view-rate', type=float, default=20, help='/view_email requests per second during the run')
+    parser.add_argument('--body-words', type=int, default=200)
+    parser.add_argument('--html', action='store_true', help='add a text/html alternative to every message')
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1, help='parser processes (0 = threads)')
+    parser.add_argument('--notify-rate', type=float, default=0, help='override NOTIFY_GLOBAL_RATE')
+    parser.add_argument('--imap-latency', type=float, default=0.0, help='seconds added to every IMAP reply')
+    parser.add_argument('--api-latency', type=float, default=0.0, help='seconds added to every Bot API call')
+    parser.add_argument('--flood-every', type=int, default=0, help='answer every Nth sendMessage with a 429')
+    parser.add_argument('--concurrency', type=int, default=50, help='concurrent HTTP requests from the drivers')
+    parser.add_argument('--drain-timeout', type=float, default=120, help='seconds to wait for the backlog after the run')
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profile', metavar='PATH', help='cProfile the event-loop thread during the run and save stats')
+    parser.add_argument('--tracemalloc', type=int, default=0, metavar='N', help='trace allocations and show the top N sites')
+    parser.add_argument('--json', metavar='PATH', help='also write the results as JSON, for tracking regressions')
+    args = parser.parse_args()
+
+    results, profiler, snapshot = asyncio.run(run(args))
+    print_report(results)
+    if profiler:
+        profiler.dump_stats(args.profile)
+        print(f"\ncProfile (event-loop thread), saved to {args.profile}:")
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+    if snapshot:
+        print(f"\nTop {args.tracemalloc} allocation sites:")
+        for stat in snapshot.statistics('lineno')[:args.tracemalloc]:
+            print(f"  {stat}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,133 @@
+# Replays Telegram update JSON against the webhook endpoint at high rate and reports handler throughput.
+#
+# In-process (default): runs the bot in webhook mode on a local port with the Bot API answered
+# locally, then measures how fast updates are accepted and fully handled:
+#
+#   python benchmarks/replay_updates.py --count 5000 --concurrency 50
+#
+# Against a running instance (only acceptance is measured, since its handlers run elsewhere):
+#
+#   python benchmarks/replay_updates.py --url https://host/telegram/webhook --secret $WEBHOOK_SECRET --updates recorded.jsonl
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import tempfile
+import time
+
+import httpx
+
+from common import FakeBotRequest, import_main, make_command_update
+
+COMMANDS = ['/start', '/help', '/myemails', '/new']
+
+def load_updates(args):
+    if args.updates:
+        with open(args.updates) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    rng = random.Random(1)
+    return [make_command_update(i + 1, rng.randrange(1, args.users + 1), rng.choice(COMMANDS)) for i in range(args.count)]
+
+async def post_all(url, secret, updates, concurrency, rate):
+    latencies, statuses = [], {}
+    semaphore = asyncio.Semaphore(concurrency)
+    interval = 1 / rate if rate else 0
+    async with httpx.AsyncClient(timeout=30, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def post(update):
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': secret})
+                latencies.append(time.perf_counter() - started)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        tasks = []
+        for update in updates:
+            tasks.append(asyncio.create_task(post(update)))
+            if interval:
+                await asyncio.sleep(interval)
+        await asyncio.gather(*tasks)
+    return latencies, statuses
+
+def report(label, count, elapsed, latencies=None):
+    line = f"{label:<10} {count} updates in {elapsed:.2f}s = {count / elapsed:,.0f} updates/s"
+    if latencies:
+        latencies = sorted(latencies)
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+        line += f"  (POST p50 {statistics.median(latencies) * 1000:.1f} ms, p99 {p99 * 1000:.1f} ms)"
+    print(line)
+
+async def run_in_process(args, updates):
+    port = args.port
+    os.environ.update({'BOT_MODE': 'webhook', 'WEB_SERVER': 'asgi', 'PORT': str(port), 'WEBHOOK_SECRET': 'replay-secret'})
+    tmp = tempfile.TemporaryDirectory()
+    main = import_main(os.path.join(tmp.name, 'replay.db'))
+    main.init_db()
+
+    from telegram import Update
+    from telegram.ext import TypeHandler
+    handled = 0
+    all_handled = asyncio.Event()
+    async def count_handled(update, context):
+        nonlocal handled
+        handled += 1
+        if handled == len(updates):
+            all_handled.set()
+
+    fake_api = FakeBotRequest()
+    application = main.build_application(request=fake_api)
+    # Group 1 runs after the command handlers in group 0, so this counts fully handled updates
+    application.add_handler(TypeHandler(Update, count_handled), group=1)
+    await application.initialize()
+    main.db.start()
+    await main.db.read(main.address_router.load)
+    await application.start()
+    main.attach_webhook(application, asyncio.get_running_loop())
+    server = main.create_asgi_server()
+    serving = asyncio.create_task(server.serve())
+    await asyncio.sleep(0.5)
+
+    started = time.perf_counter()
+    latencies, statuses = await post_all(f'http://127.0.0.1:{port}{main.WEBHOOK_PATH}', 'replay-secret', updates, args.concurrency, args.rate)
+    accepted = time.perf_counter() - started
+    await asyncio.wait_for(all_handled.wait(), timeout=300)
+    done = time.perf_counter() - started
+
+    print(f"HTTP statuses: {statuses}; Bot API calls: {dict(fake_api.calls)}")
+    report('accepted', len(updates), accepted, latencies)
+    report('handled', handled, done)
+
+    server.should_exit = True
+    await serving
+    await application.stop()
+    await application.shutdown()
+    main.db.close()
+    tmp.cleanup()
+
+async def run_remote(args, updates):
+    started = time.perf_counter()
+    latencies, statuses = await post_all(args.url, args.secret, updates, args.concurrency, args.rate)
+    print(f"HTTP statuses: {statuses}")
+    report('accepted', len(updates), time.perf_counter() - started, latencies)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='Replay Telegram updates against the webhook endpoint.')
+    parser.add_argument('--updates', help='JSONL file of recorded updates (default: synthetic commands)')
+    parser.add_argument('--count', type=int, default=2000, help='number of synthetic updates')
+    parser.add_argument('--users', type=int, default=500, help='distinct synthetic users')
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=0, help='updates per second (0 = as fast as possible)')
+    parser.add_argument('--url', help='webhook URL of a running instance')
+    parser.add_argument('--secret', default='', help='WEBHOOK_SECRET of the running instance')
+    parser.add_argument('--port', type=int, default=18080, help='port for the in-process server')
+    args = parser.parse_args()
+
+    updates = load_updates(args)
+    if args.url:
+        asyncio.run(run_remote(args, updates))
+    else:
+        asyncio.run(run_in_process(args, updates))
+
+if __name__ == '__main__':
+    main_cli()
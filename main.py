@@ -3,23 +3,38 @@
 
 import logging
 import asyncio
+import multiprocessing
+import queue
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timedelta
 import os
 import random
 import string
 import re
+import hashlib
+import hmac
+import secrets
+import signal
+import contextlib
 import imaplib
+import json
+import select
+import ssl
+import threading
+import time
+import zlib
 import email
 from email.header import decode_header
-from flask import Flask
-from markupsafe import escape  # <<< FIX: Import escape from markupsafe
+from flask import Flask, make_response, request
 from threading import Thread
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter, OrderedDict
+from typing import NamedTuple
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand, BotCommandScopeChat
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
 from telegram.constants import ParseMode
-from telegram.error import BadRequest
+from telegram.error import BadRequest, Forbidden, RetryAfter
 
 # --- FLASK WEB SERVER ---
 app = Flask(__name__)
@@ -33,6 +48,23 @@ def start_web_server_in_thread():
     t.daemon = True
     t.start()
 
+def create_asgi_server():
+    """Builds the uvicorn server that serves the Flask app on the bot's own event loop (WEB_SERVER=asgi).
+
+    Run it with `await server.serve()`; setting `server.should_exit` stops it gracefully.
+    """
+    import uvicorn
+    from a2wsgi import WSGIMiddleware
+
+    class EmbeddedServer(uvicorn.Server):
+        # python-telegram-bot owns the loop and its signal handlers
+        def capture_signals(self):
+            return contextlib.nullcontext()
+
+    config = uvicorn.Config(WSGIMiddleware(app, workers=WEB_WORKERS), host='0.0.0.0', port=int(os.environ.get('PORT', 8080)),
+                            log_level='warning', access_log=False, date_header=False, timeout_graceful_shutdown=5)
+    return EmbeddedServer(config)
+
 @app.route('/')
 def home():
     return "Bot is alive and running with external inbox!"
@@ -46,71 +78,623 @@ try:
     BOT_TOKEN = os.environ['BOT_TOKEN']
     # NEW: Separate domains for email generation and web hosting
     EMAIL_DOMAIN = os.environ['EMAIL_DOMAIN'] # Your custom domain for emails, e.g., "iam1.qzz.io"
+    # Every domain the catch-all mailboxes receive; /new spreads addresses across them
+    EMAIL_DOMAINS = [domain.strip().lower() for domain in os.environ.get('EMAIL_DOMAINS', EMAIL_DOMAIN).split(',') if domain.strip()]
     APP_HOST_DOMAIN = os.environ['APP_HOST_DOMAIN'] # Your Render app domain, e.g., "my-bot.onrender.com"
     
-    CATCH_ALL_EMAIL = os.environ['CATCH_ALL_EMAIL']
-    CATCH_ALL_PASSWORD = os.environ['CATCH_ALL_PASSWORD']
     ADMIN_ID = int(os.environ.get('ADMIN_ID', 0))
-    IMAP_SERVER = "imap.gmail.com"
+    IMAP_SERVER = os.environ.get('IMAP_SERVER', "imap.gmail.com")
+    # Catch-all mailboxes, each fetched by its own worker with its own connection and checkpoint.
+    # A JSON list of {"user", "password", "host", "port", "ssl", "mailbox"}; only user and password
+    # are required. Without it, the single CATCH_ALL_EMAIL mailbox on IMAP_SERVER is used.
+    IMAP_ACCOUNTS = json.loads(os.environ['IMAP_ACCOUNTS']) if os.environ.get('IMAP_ACCOUNTS') else [
+        {'user': os.environ['CATCH_ALL_EMAIL'], 'password': os.environ['CATCH_ALL_PASSWORD']}]
     DAILY_LIMIT = 10
+    # IMAP IDLE: servers drop an idle session after ~29 minutes, so IDLE is re-issued before that
+    IMAP_IDLE_TIMEOUT = int(os.environ.get('IMAP_IDLE_TIMEOUT', 25 * 60))
+    IMAP_POLL_INTERVAL = int(os.environ.get('IMAP_POLL_INTERVAL', 45)) # Fallback for servers without IDLE
+    IMAP_MAX_BACKOFF = int(os.environ.get('IMAP_MAX_BACKOFF', 300))
+    # Bounds every blocking socket read, so a half-open connection fails and reconnects instead of hanging
+    IMAP_SOCKET_TIMEOUT = float(os.environ.get('IMAP_SOCKET_TIMEOUT', 120))
+    IMAP_FETCH_CHUNK = int(os.environ.get('IMAP_FETCH_CHUNK', 200)) # Messages per UID FETCH/STORE round trip
+    # Ingest pipeline: bounded queues between stages give backpressure all the way back to IMAP
+    INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', 500))
+    PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 4))
+    # 0 parses in threads instead. Each process re-imports this module (~45 MB), and in a container
+    # cpu_count() is the host's, so the default stays small
+    PARSE_PROCESSES = int(os.environ.get('PARSE_PROCESSES', min(2, len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1)))
+    DB_BATCH_SIZE = int(os.environ.get('DB_BATCH_SIZE', 100))
+    INGEST_DRAIN_TIMEOUT = float(os.environ.get('INGEST_DRAIN_TIMEOUT', 10)) # Shutdown wait for queued emails to be stored
+    PIPELINE_STATS_INTERVAL = int(os.environ.get('PIPELINE_STATS_INTERVAL', 300))
+    DB_READERS = int(os.environ.get('DB_READERS', 4)) # Pooled read connections
+    DB_WRITE_BATCH = int(os.environ.get('DB_WRITE_BATCH', 200)) # Max writes folded into one commit
+    RECENT_MESSAGE_IDS = int(os.environ.get('RECENT_MESSAGE_IDS', 50000)) # Dedup window for ingest
+    # Notification dispatcher; Telegram allows ~30 messages/s overall and ~1 message/s per chat
+    NOTIFY_GLOBAL_RATE = float(os.environ.get('NOTIFY_GLOBAL_RATE', 25))
+    NOTIFY_CHAT_INTERVAL = float(os.environ.get('NOTIFY_CHAT_INTERVAL', 1.0))
+    NOTIFY_CONCURRENCY = int(os.environ.get('NOTIFY_CONCURRENCY', 10))
+    NOTIFY_DIGEST_MAX = int(os.environ.get('NOTIFY_DIGEST_MAX', 10)) # Emails folded into one digest message
+    NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))
+    NOTIFY_MAX_PENDING = int(os.environ.get('NOTIFY_MAX_PENDING', 5000)) # In-memory backlog before ingest waits
+    # Retention: 0, the default, keeps rows forever; address expiry also removes the address's emails
+    EMAIL_TTL_DAYS = int(os.environ.get('EMAIL_TTL_DAYS', 0))
+    ADDRESS_TTL_DAYS = int(os.environ.get('ADDRESS_TTL_DAYS', 0))
+    RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL', 3600))
+    RETENTION_BATCH = int(os.environ.get('RETENTION_BATCH', 500)) # Rows deleted per write, keeping each short
+    BODY_COMPRESSION_LEVEL = int(os.environ.get('BODY_COMPRESSION_LEVEL', 6)) # zlib level for stored bodies
+    VACUUM_PAGES = int(os.environ.get('VACUUM_PAGES', 2000)) # Free pages returned to the filesystem per step
+    WEB_SERVER = os.environ.get('WEB_SERVER', 'flask') # 'asgi' serves via uvicorn on the bot's event loop
+    WEB_WORKERS = int(os.environ.get('WEB_WORKERS', 10)) # Threads running Flask views in ASGI mode
+    # 'webhook' receives updates on the web server's port instead of long polling
+    BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+    WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/telegram/webhook')
+    WEBHOOK_URL = os.environ.get('WEBHOOK_URL', f"https://{APP_HOST_DOMAIN}{WEBHOOK_PATH}")
+    # Registered with Telegram on every start, so a random one works unless several instances share the bot
+    WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET') or secrets.token_urlsafe(32)
+    EMAIL_PAGE_CACHE_SIZE = int(os.environ.get('EMAIL_PAGE_CACHE_SIZE', 1000)) # Rendered /view_email pages kept in memory
+    EMAIL_PAGE_MAX_AGE = int(os.environ.get('EMAIL_PAGE_MAX_AGE', 86400)) # Browser cache lifetime; emails never change
+    ADMIN_USER_LIST = int(os.environ.get('ADMIN_USER_LIST', 50)) # Users shown in the admin list, busiest first
+    # A self-hosted Bot API server, or a local stub when load testing
+    TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+    # /metrics answers only "Authorization: Bearer <token>" requests, and is off (404) while this is unset
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
 except KeyError as e:
     print(f"!!! FATAL ERROR: Environment variable {e} is not set on Render.com !!!")
     exit()
 
 # --- DATABASE SETUP ---
 DB_PATH = '/data/tempmail.db' if os.path.exists('/data') else 'tempmail.db'
-db_lock = asyncio.Lock()
 
 def get_db_conn():
-    return sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    conn = sqlite3.connect(DB_PATH, timeout=10, check_same_thread=False, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+    # WAL lets readers run concurrently with the single writer
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    # Off by default in SQLite; needed for the ON DELETE CASCADE clauses to take effect
+    conn.execute("PRAGMA foreign_keys=ON")
+    return conn
+
+# --- EMAIL BODY STORAGE ---
+# Bodies live in email_bodies, apart from the email metadata, as a one-byte format marker plus payload:
+# b'z' zlib-compressed UTF-8, b'r' raw UTF-8 (too short to be worth compressing).
+# Rows stored before this format keep their plain TEXT in emails.body and are read as-is.
+BODY_MIN_COMPRESS = 64
+
+def encode_body(text):
+    data = text.encode('utf-8')
+    if len(data) >= BODY_MIN_COMPRESS:
+        compressed = zlib.compress(data, BODY_COMPRESSION_LEVEL)
+        if len(compressed) < len(data):
+            return b'z' + compressed
+    return b'r' + data
+
+def decode_body(value):
+    if value is None or isinstance(value, str):
+        return value # Legacy plain-text body
+    marker, payload = value[:1], value[1:]
+    if marker == b'z':
+        return zlib.decompress(payload).decode('utf-8')
+    if marker == b'r':
+        return payload.decode('utf-8')
+    raise ValueError(f"Unknown body storage format {marker!r}")
+
+def _move_legacy_bodies(conn, batch=500):
+    """Moves bodies still stored inline in emails.body into email_bodies, compressed."""
+    last_id = 0
+    while True:
+        # Keyset paging: each batch starts after the last one instead of re-skipping moved rows
+        rows = conn.execute("SELECT id, body FROM emails WHERE id > ? AND body IS NOT NULL ORDER BY id LIMIT ?",
+                            (last_id, batch)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        conn.executemany("INSERT OR REPLACE INTO email_bodies (email_id, body) VALUES (?, ?)",
+                         [(email_id, encode_body(body)) for email_id, body in rows])
+        conn.executemany("UPDATE emails SET body = NULL WHERE id = ?", [(email_id,) for email_id, _ in rows])
+        conn.commit()
+
+# Each entry moves the schema up one version; PRAGMA user_version records the version a DB is at.
+# Statements must be idempotent, because databases created before migrations existed start at 0;
+# a callable entry is run with the connection for data migrations that SQL alone cannot express.
+MIGRATIONS = [
+    # 1: base tables
+    [
+        '''CREATE TABLE IF NOT EXISTS addresses (
+            id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
+            full_address TEXT NOT NULL UNIQUE, creation_date DATE NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS emails (
+            id INTEGER PRIMARY KEY, address_id INTEGER NOT NULL, message_id TEXT UNIQUE,
+            from_address TEXT NOT NULL, subject TEXT NOT NULL, body TEXT,
+            received_at timestamp,
+            FOREIGN KEY (address_id) REFERENCES addresses (id) ON DELETE CASCADE
+        )''',
+        '''CREATE TABLE IF NOT EXISTS imap_checkpoints (
+            mailbox TEXT PRIMARY KEY, uidvalidity INTEGER NOT NULL, last_uid INTEGER NOT NULL
+        )''',
+    ],
+    # 2: covering index for the daily-limit count, /myemails and the per-user admin aggregates,
+    #    and an index for listing/expiring an address's emails by date
+    [
+        "CREATE INDEX IF NOT EXISTS idx_addresses_user_date ON addresses (user_id, creation_date)",
+        "CREATE INDEX IF NOT EXISTS idx_emails_address_received ON emails (address_id, received_at)",
+    ],
+    # 3: notifications that have not been delivered yet, so they survive a restart
+    [
+        '''CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY, email_id INTEGER NOT NULL, chat_id INTEGER NOT NULL,
+            FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE
+        )''',
+    ],
+    # 4: retention; VACUUM is what switches an existing database to incremental auto-vacuum
+    [
+        "PRAGMA auto_vacuum = INCREMENTAL",
+        "VACUUM",
+        "CREATE INDEX IF NOT EXISTS idx_emails_received ON emails (received_at)",
+        "CREATE INDEX IF NOT EXISTS idx_addresses_creation ON addresses (creation_date)",
+    ],
+    # 5: compressed bodies in their own table, so scanning email metadata never reads body pages
+    [
+        '''CREATE TABLE IF NOT EXISTS email_bodies (
+            email_id INTEGER PRIMARY KEY, body BLOB NOT NULL,
+            FOREIGN KEY (email_id) REFERENCES emails (id) ON DELETE CASCADE
+        )''',
+        _move_legacy_bodies,
+    ],
+    # 6: deleting an email looks up its outbox rows for the cascade; without this that scans the outbox
+    [
+        "CREATE INDEX IF NOT EXISTS idx_outbox_email ON outbox (email_id)",
+    ],
+    # 7: counters kept current by triggers, so admin stats never aggregate over addresses or emails
+    [
+        '''CREATE TABLE IF NOT EXISTS user_stats (
+            user_id INTEGER PRIMARY KEY, addresses INTEGER NOT NULL
+        )''',
+        '''CREATE TABLE IF NOT EXISTS stats_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1), addresses INTEGER NOT NULL, emails INTEGER NOT NULL
+        )''',
+        "INSERT OR REPLACE INTO user_stats (user_id, addresses) SELECT user_id, COUNT(*) FROM addresses GROUP BY user_id",
+        "INSERT OR REPLACE INTO stats_totals (id, addresses, emails) VALUES (1, (SELECT COUNT(*) FROM addresses), (SELECT COUNT(*) FROM emails))",
+        '''CREATE TRIGGER IF NOT EXISTS stats_address_insert AFTER INSERT ON addresses BEGIN
+            INSERT INTO user_stats (user_id, addresses) VALUES (NEW.user_id, 1)
+                ON CONFLICT(user_id) DO UPDATE SET addresses = addresses + 1;
+            UPDATE stats_totals SET addresses = addresses + 1 WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_address_delete AFTER DELETE ON addresses BEGIN
+            UPDATE user_stats SET addresses = addresses - 1 WHERE user_id = OLD.user_id;
+            DELETE FROM user_stats WHERE user_id = OLD.user_id AND addresses <= 0;
+            UPDATE stats_totals SET addresses = addresses - 1 WHERE id = 1;
+        END''',
+        # Also fire for emails removed by the addresses cascade
+        '''CREATE TRIGGER IF NOT EXISTS stats_email_insert AFTER INSERT ON emails BEGIN
+            UPDATE stats_totals SET emails = emails + 1 WHERE id = 1;
+        END''',
+        '''CREATE TRIGGER IF NOT EXISTS stats_email_delete AFTER DELETE ON emails BEGIN
+            UPDATE stats_totals SET emails = emails - 1 WHERE id = 1;
+        END''',
+    ],
+]
+
+def apply_migrations(conn, target=None):
+    """Applies pending migrations up to `target` (default: latest) and returns the resulting version."""
+    target = len(MIGRATIONS) if target is None else target
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    while version < target:
+        for statement in MIGRATIONS[version]:
+            if callable(statement):
+                statement(conn)
+            else:
+                conn.execute(statement)
+        version += 1
+        conn.execute(f"PRAGMA user_version = {version}")
+        conn.commit()
+        logger.info(f"Applied DB migration {version}")
+    return version
 
 def init_db():
     with get_db_conn() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS addresses (
-                id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL,
-                full_address TEXT NOT NULL UNIQUE, creation_date DATE NOT NULL
-            )
-        ''')
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS emails (
-                id INTEGER PRIMARY KEY, address_id INTEGER NOT NULL, message_id TEXT UNIQUE,
-                from_address TEXT NOT NULL, subject TEXT NOT NULL, body TEXT,
-                received_at timestamp,
-                FOREIGN KEY (address_id) REFERENCES addresses (id) ON DELETE CASCADE
-            )
-        ''')
-        conn.commit()
+        apply_migrations(conn)
+        for name, plan in check_query_plans(conn).items():
+            logger.warning(f"Query '{name}' does a full table scan: {plan}")
+
+# --- QUERIES ---
+# Hot-path statements live here so their plans can be checked against the indexes above.
+QUERIES = {
+    'daily_address_count': "SELECT COUNT(*) FROM addresses WHERE user_id = ? AND creation_date = ?",
+    'insert_address': "INSERT INTO addresses (user_id, full_address, creation_date) VALUES (?, ?, ?)",
+    'user_addresses': "SELECT full_address FROM addresses WHERE user_id = ?",
+    'stats_totals': "SELECT addresses, emails FROM stats_totals WHERE id = 1",
+    'insert_email': "INSERT OR IGNORE INTO emails (address_id, message_id, from_address, subject, received_at) VALUES (?, ?, ?, ?, ?)",
+    'insert_email_body': "INSERT INTO email_bodies (email_id, body) VALUES (?, ?)",
+    'insert_outbox': "INSERT INTO outbox (email_id, chat_id) VALUES (?, ?)",
+    'delete_outbox': "DELETE FROM outbox WHERE id = ?",
+    'expired_emails': "SELECT id FROM emails WHERE received_at < ? LIMIT ?",
+    'expired_addresses': "SELECT id, full_address, user_id FROM addresses WHERE creation_date < ? LIMIT ?",
+    'email_view': "SELECT e.from_address, e.subject, COALESCE(b.body, e.body), e.received_at FROM emails e LEFT JOIN email_bodies b ON b.email_id = e.id WHERE e.id = ?",
+    'load_imap_checkpoint': "SELECT uidvalidity, last_uid FROM imap_checkpoints WHERE mailbox = ?",
+}
+
+def explain_query(conn, sql):
+    """Returns the EXPLAIN QUERY PLAN detail lines for a statement, binding NULL to every parameter."""
+    rows = conn.execute(f"EXPLAIN QUERY PLAN {sql}", (None,) * sql.count('?')).fetchall()
+    return [row[-1] for row in rows]
+
+def check_query_plans(conn):
+    """Returns {name: plan} for every query in QUERIES whose plan scans a table without an index."""
+    full_scans = {}
+    for name, sql in QUERIES.items():
+        plan = explain_query(conn, sql)
+        # "SCAN addresses USING COVERING INDEX ..." reads only the index; a bare "SCAN addresses" reads every row
+        if any(re.fullmatch(r'SCAN \w+', detail) for detail in plan):
+            full_scans[name] = plan
+    return full_scans
+
+def load_imap_checkpoint(conn, mailbox):
+    """Returns the (uidvalidity, last_uid) high-water mark stored for a mailbox, or None."""
+    return conn.execute(QUERIES['load_imap_checkpoint'], (mailbox,)).fetchone()
+
+def save_imap_checkpoint(conn, mailbox, uidvalidity, last_uid):
+    conn.execute(
+        "INSERT INTO imap_checkpoints (mailbox, uidvalidity, last_uid) VALUES (?, ?, ?) "
+        "ON CONFLICT(mailbox) DO UPDATE SET uidvalidity = excluded.uidvalidity, last_uid = excluded.last_uid",
+        (mailbox, uidvalidity, last_uid))
+
+# --- DATABASE ACCESS LAYER ---
+class Database:
+    """Pooled SQLite access: a pool of WAL read connections plus one writer task that group-commits.
+
+    Reads and writes run in worker threads, so awaiting them never blocks the event loop, and
+    reads never wait behind ingest writes. Write functions receive the writer connection and run
+    inside a savepoint of a shared transaction; they must not call commit() themselves.
+    """
+
+    def __init__(self, readers=DB_READERS):
+        self._max_readers = readers
+        self._readers = queue.LifoQueue()
+        self._reader_count = 0
+        self._reader_lock = threading.Lock()
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix='db-read')
+        self._write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-write')
+        self._writer_conn = None
+        self._write_queue = None
+        self._writer_task = None
+
+    @contextlib.contextmanager
+    def reader(self):
+        """Borrows a pooled read connection. Usable from any thread, e.g. Flask views."""
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._reader_lock:
+                create = self._reader_count < self._max_readers
+                self._reader_count += create
+            conn = get_db_conn() if create else self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def _run_read(self, fn, args):
+        with self.reader() as conn:
+            return fn(conn, *args)
+
+    async def read(self, fn, *args):
+        """Runs fn(conn, *args) on a pooled read connection in a worker thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor, self._run_read, fn, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchall())
+
+    def start(self):
+        """Starts the writer task; must be called from the running event loop."""
+        self._write_queue = asyncio.Queue()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def write(self, fn, *args):
+        """Runs fn(conn, *args) in the next group commit and returns its result (or raises its error)."""
+        future = asyncio.get_running_loop().create_future()
+        await self._write_queue.put((fn, args, future))
+        return await future
+
+    async def execute(self, sql, params=()):
+        return await self.write(lambda conn: conn.execute(sql, params).lastrowid)
+
+    async def _writer_loop(self):
+        while True:
+            batch = [await self._write_queue.get()]
+            while len(batch) < DB_WRITE_BATCH and not self._write_queue.empty():
+                batch.append(self._write_queue.get_nowait())
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(self._write_executor, self._run_batch, batch)
+            except Exception as e:
+                # The commit itself failed, so none of the batch was stored
+                logger.error(f"DB group commit of {len(batch)} writes failed: {e}", exc_info=True)
+                results = [(False, e)] * len(batch)
+            for (_, _, future), (ok, value) in zip(batch, results):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def _run_batch(self, batch):
+        if self._writer_conn is None:
+            self._writer_conn = get_db_conn()
+            self._writer_conn.isolation_level = None # Transactions are managed explicitly below
+        conn = self._writer_conn
+        results = []
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for fn, args, _ in batch:
+                # A savepoint per write lets one failing write roll back alone
+                conn.execute("SAVEPOINT write")
+                try:
+                    results.append((True, fn(conn, *args)))
+                    conn.execute("RELEASE write")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    conn.execute("RELEASE write")
+                    results.append((False, e))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return results
+
+    def close(self):
+        if self._writer_task:
+            self._writer_task.cancel()
+        self._read_executor.shutdown(wait=False)
+        self._write_executor.shutdown(wait=False)
+
+db = Database()
+
+# --- ADDRESS ROUTING CACHE ---
+class AddressRouter:
+    """In-memory map of full_address -> (address_id, user_id).
+
+    Ingest consults this instead of SQLite, so catch-all mail for addresses nobody owns is
+    dropped without a DB round trip. Loaded once at startup and kept current by new_email.
+    """
+
+    def __init__(self):
+        self._routes = {}
+
+    def load(self, conn):
+        self._routes = {full_address: (address_id, user_id) for full_address, address_id, user_id
+                        in conn.execute("SELECT full_address, id, user_id FROM addresses")}
+        logger.info(f"Loaded {len(self._routes)} address routes")
+
+    def add(self, full_address, address_id, user_id):
+        self._routes[full_address] = (address_id, user_id)
+
+    def remove(self, full_address):
+        self._routes.pop(full_address, None)
+
+    def lookup(self, full_address):
+        return self._routes.get(full_address)
+
+    def __len__(self):
+        return len(self._routes)
+
+class RecentMessageIds:
+    """Bounded LRU set of recently stored Message-IDs, so re-delivered duplicates skip the DB.
+
+    Ids are added only once their email is committed; one added earlier would make a retry of a
+    failed write look like a duplicate.
+    """
+
+    def __init__(self, capacity=RECENT_MESSAGE_IDS):
+        self.capacity = capacity
+        self._ids = OrderedDict()
+
+    def __contains__(self, message_id):
+        if message_id in self._ids:
+            self._ids.move_to_end(message_id)
+            return True
+        return False
+
+    def add(self, message_id):
+        self._ids[message_id] = None
+        self._ids.move_to_end(message_id)
+        if len(self._ids) > self.capacity:
+            self._ids.popitem(last=False)
+
+address_router = AddressRouter()
+recent_message_ids = RecentMessageIds()
+
+# --- ADMIN STATISTICS & METRICS ---
+class AdminStats:
+    """In-memory mirror of the counters the migration-7 triggers keep in user_stats/stats_totals.
+
+    Loaded once at startup, then moved by the same code paths that add and delete the rows, so
+    the admin panel and /metrics never aggregate over addresses or emails. Also gathers the
+    pipeline, dispatcher and retention stats once those are running.
+    """
+
+    def __init__(self):
+        self._per_user = Counter()
+        self.addresses = 0
+        self.emails = 0
+        self.pipeline = None
+        self.retention = None
+
+    def load(self, conn):
+        self._per_user = Counter(dict(conn.execute("SELECT user_id, addresses FROM user_stats")))
+        self.addresses, self.emails = conn.execute(QUERIES['stats_totals']).fetchone()
+        logger.info(f"Loaded stats: {self.users} users, {self.addresses} addresses, {self.emails} emails")
+
+    @property
+    def users(self):
+        return len(self._per_user)
+
+    def address_added(self, user_id):
+        self._per_user[user_id] += 1
+        self.addresses += 1
+
+    def address_removed(self, user_id):
+        self._per_user[user_id] -= 1
+        if self._per_user[user_id] <= 0:
+            del self._per_user[user_id]
+        self.addresses -= 1
+
+    def emails_added(self, count):
+        self.emails += count
+
+    def emails_removed(self, count):
+        self.emails -= count
+
+    def top_users(self, limit=ADMIN_USER_LIST):
+        """Returns [(user_id, address count)] for the users with the most addresses."""
+        return self._per_user.most_common(limit)
+
+    def snapshot(self):
+        stats = {
+            'users': self.users,
+            'addresses': self.addresses,
+            'emails': self.emails,
+            'db_size_bytes': os.path.getsize(DB_PATH) if os.path.exists(DB_PATH) else 0,
+        }
+        if self.pipeline:
+            stats['pipeline'] = self.pipeline.stats()
+        if self.retention:
+            stats['retention'] = self.retention.stats()
+        return stats
+
+admin_stats = AdminStats()
+
+def render_metrics(stats):
+    """Formats an AdminStats snapshot in the Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP tempmail_{name} {help_text}")
+        lines.append(f"# TYPE tempmail_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"tempmail_{name}{labels} {value}")
+
+    metric('users', 'gauge', 'Users with at least one address.', [('', stats['users'])])
+    metric('addresses', 'gauge', 'Addresses stored.', [('', stats['addresses'])])
+    metric('emails', 'gauge', 'Emails stored.', [('', stats['emails'])])
+    metric('db_size_bytes', 'gauge', 'Size of the SQLite database file.', [('', stats['db_size_bytes'])])
+
+    pipeline = stats.get('pipeline')
+    if pipeline:
+        stages = [(name, pipeline[name]) for name in ('fetch', 'parse', 'write')]
+        for key, name, kind, help_text in [
+            ('processed', 'stage_processed_total', 'counter', 'Emails handled by an ingest stage.'),
+            ('errors', 'stage_errors_total', 'counter', 'Emails an ingest stage failed on.'),
+            ('dropped', 'stage_dropped_total', 'counter', 'Emails an ingest stage discarded (unknown recipient, duplicate).'),
+            ('busy_seconds', 'stage_busy_seconds_total', 'counter', 'Time an ingest stage spent working.'),
+            ('queue_depth', 'stage_queue_depth', 'gauge', 'Items waiting in front of an ingest stage.'),
+        ]:
+            metric(name, kind, help_text, [(f'{{stage="{stage}"}}', values[key]) for stage, values in stages])
+        fetch = pipeline['fetch']
+        metric('imap_fetch_seconds', 'summary', 'IMAP search/fetch/store round trips.',
+               [('_sum', fetch['busy_seconds']), ('_count', fetch['calls'])])
+        metric('imap_last_fetch_seconds', 'gauge', 'Duration of the latest IMAP round trip.', [('', fetch['last_seconds'])])
+
+        notify = pipeline['notify']
+        metric('notifications_sent_total', 'counter', 'Email notifications delivered.', [('', notify['sent'])])
+        metric('notification_messages_total', 'counter', 'Telegram messages sent, digests included.', [('', notify['messages'])])
+        metric('notifications_failed_total', 'counter', 'Email notifications given up on.', [('', notify['failed'])])
+        metric('notification_retries_total', 'counter', 'Telegram sends retried after an error.', [('', notify['retried'])])
+        metric('notifications_pending', 'gauge', 'Email notifications waiting to be delivered.', [('', notify['pending'])])
+
+    retention = stats.get('retention')
+    if retention:
+        metric('retention_emails_purged_total', 'counter', 'Emails deleted by retention.', [('', retention['emails_purged'])])
+        metric('retention_addresses_purged_total', 'counter', 'Addresses deleted by retention.', [('', retention['addresses_purged'])])
+        metric('retention_bytes_reclaimed_total', 'counter', 'Bytes returned to the filesystem by incremental vacuum.', [('', retention['bytes_reclaimed'])])
+    return '\n'.join(lines) + '\n'
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape target; it exposes user counts and queue state, so it is never served without a token."""
+    if not METRICS_TOKEN:
+        return "Not Found", 404
+    if not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {METRICS_TOKEN}"):
+        return "Unauthorized", 401
+    response = make_response(render_metrics(admin_stats.snapshot()))
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
 # --- FLASK ROUTE TO DISPLAY EMAILS ---
+# Compiled once at import; the Flask Jinja environment autoescapes every value
+EMAIL_PAGE_TEMPLATE = app.jinja_env.from_string("""<!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">
+<title>{{ subject }}</title><style>body{font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Helvetica,Arial,sans-serif;line-height:1.6;margin:0;padding:20px;background-color:#f4f4f9;color:#333;}.container{max-width:800px;margin:auto;background:#fff;padding:25px;border-radius:8px;box-shadow:0 2px 10px rgba(0,0,0,0.1);}h1{font-size:1.8em;color:#111;margin-top:0;}.meta-info{font-size:0.9em;color:#555;border-bottom:1px solid #eee;padding-bottom:15px;margin-bottom:20px;}.meta-info p{margin:5px 0;}.email-body{font-size:1em;white-space:pre-wrap;word-wrap:break-word;}b{color:#000;}</style></head>
+<body><div class="container"><h1>{{ subject }}</h1><div class="meta-info"><p><b>From:</b> {{ from_addr }}</p><p><b>Received:</b> {{ received_at }}</p></div>
+<div class="email-body">{% if body %}{{ body }}{% else %}<p><i>[This email has no content]</i></p>{% endif %}</div></div></body></html>
+""")
+
+class EmailPage(NamedTuple):
+    html: str
+    etag: str
+    received_at: datetime
+
+class PageCache:
+    """Thread-safe LRU of rendered email pages; stored emails never change, so entries stay valid until deleted."""
+
+    def __init__(self, capacity=EMAIL_PAGE_CACHE_SIZE):
+        self.capacity = capacity
+        self._pages = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, email_id):
+        with self._lock:
+            page = self._pages.get(email_id)
+            if page is not None:
+                self._pages.move_to_end(email_id)
+            return page
+
+    def put(self, email_id, page):
+        with self._lock:
+            self._pages[email_id] = page
+            if len(self._pages) > self.capacity:
+                self._pages.popitem(last=False)
+
+    def discard(self, email_id):
+        with self._lock:
+            self._pages.pop(email_id, None)
+
+email_page_cache = PageCache()
+
+def render_email_page(from_addr, subject, stored_body, received_at_obj):
+    body = decode_body(stored_body)
+    received_at_str = received_at_obj.strftime('%Y-%m-%d %H:%M:%S') if isinstance(received_at_obj, datetime) else "N/A"
+    # white-space:pre-wrap keeps the body's line breaks, so no <br> conversion is needed
+    html = EMAIL_PAGE_TEMPLATE.render(from_addr=from_addr, subject=subject, body=body, received_at=received_at_str)
+    etag = hashlib.sha1(html.encode()).hexdigest()[:20]
+    return EmailPage(html, etag, received_at_obj if isinstance(received_at_obj, datetime) else None)
+
 @app.route('/view_email/<int:email_id>')
 def view_email(email_id):
-    """Renders a simple HTML page to display the email content."""
+    """Renders a simple HTML page to display the email content, from the page cache when possible."""
     try:
-        with get_db_conn() as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT from_address, subject, body, received_at FROM emails WHERE id = ?", (email_id,))
-            email_data = cursor.fetchone()
-
-        if not email_data:
-            return "<h1>Email not found</h1><p>The email you are looking for does not exist or has been deleted.</p>", 404
-
-        from_addr, subject, body, received_at_obj = email_data
-        received_at_str = received_at_obj.strftime('%Y-%m-%d %H:%M:%S') if isinstance(received_at_obj, datetime) else "N/A"
-        safe_from = escape(from_addr)
-        safe_subject = escape(subject)
-        # The body is already escaped by the escape_markdown function for Telegram, 
-        # but we should escape it for HTML display as well.
-        safe_body = escape(body).replace('\n', '<br>')
-
-        html = f"""
-        <!DOCTYPE html><html lang="en"><head><meta charset="UTF-8"><meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>{safe_subject}</title><style>body{{font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,Helvetica,Arial,sans-serif;line-height:1.6;margin:0;padding:20px;background-color:#f4f4f9;color:#333;}}.container{{max-width:800px;margin:auto;background:#fff;padding:25px;border-radius:8px;box-shadow:0 2px 10px rgba(0,0,0,0.1);}}h1{{font-size:1.8em;color:#111;margin-top:0;}}.meta-info{{font-size:0.9em;color:#555;border-bottom:1px solid #eee;padding-bottom:15px;margin-bottom:20px;}}.meta-info p{{margin:5px 0;}}.email-body{{font-size:1em;white-space:pre-wrap;word-wrap:break-word;}}b{{color:#000;}}</style></head>
-        <body><div class="container"><h1>{safe_subject}</h1><div class="meta-info"><p><b>From:</b> {safe_from}</p><p><b>Received:</b> {received_at_str}</p></div>
-        <div class="email-body">{safe_body if safe_body else "<p><i>[This email has no content]</i></p>"}</div></div></body></html>
-        """
-        return html
+        page = email_page_cache.get(email_id)
+        if page is None:
+            with db.reader() as conn:
+                email_data = conn.execute(QUERIES['email_view'], (email_id,)).fetchone()
+
+            if not email_data:
+                return "<h1>Email not found</h1><p>The email you are looking for does not exist or has been deleted.</p>", 404
+
+            page = render_email_page(*email_data)
+            email_page_cache.put(email_id, page)
+
+        response = make_response(page.html)
+        response.set_etag(page.etag)
+        if page.received_at:
+            response.last_modified = page.received_at
+        # Private: the URLs are guessable ids, so shared caches must not keep a copy of someone's mail
+        response.cache_control.private = True
+        response.cache_control.max_age = EMAIL_PAGE_MAX_AGE
+        # Answers If-None-Match / If-Modified-Since with a bodiless 304
+        return response.make_conditional(request)
     except Exception as e:
         logger.error(f"Error rendering email view for ID {email_id}: {e}")
         return "<h1>Server Error</h1><p>An error occurred while trying to display the email.</p>", 500
@@ -128,51 +712,54 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("👋 Bot မှကြိုဆိုပါတယ်။ Email အသစ်ဖန်တီးရန် `/new` ကိုသုံးပါ။")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = "*ℹ️ အကူအညီ နှင့် အသုံးပြုပုံ*\n\n- `/new`: ကျပန်းနာမည်ဖြင့် email ဖန်တီးရန်။\n- `/new <name>`: ကိုယ်ပိုင်နာမည်ဖြင့် email ဖန်တီးရန်။\n- `/myemails`: သင်ဖန်တီးထားသော email လိပ်စာများကို ကြည့်ရန်။\n- `/admin`: (Admin only) Bot ကို ထိန်းချုပ်ရန်။"
+    help_text = "*ℹ️ အကူအညီ နှင့် အသုံးပြုပုံ*\n\n- `/new`: ကျပန်းနာမည်ဖြင့် email ဖန်တီးရန်။\n- `/new <name>`: ကိုယ်ပိုင်နာမည်ဖြင့် email ဖန်တီးရန်။\n- `/new <name> <domain>`: Domain ရွေးပြီး email ဖန်တီးရန်။\n- `/myemails`: သင်ဖန်တီးထားသော email လိပ်စာများကို ကြည့်ရန်။\n- `/admin`: (Admin only) Bot ကို ထိန်းချုပ်ရန်။"
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN_V2)
 
 async def new_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     username = ''.join(random.choices(string.ascii_lowercase + string.digits, k=8))
+    # Spreading addresses over the domains spreads incoming mail over the mailboxes that receive them
+    domain = random.choice(EMAIL_DOMAINS)
     if context.args:
-        arg_name = context.args[0].lower()
+        arg_name, _, arg_domain = context.args[0].lower().partition('@')
+        arg_domain = arg_domain or (context.args[1].lower() if len(context.args) > 1 else '')
+        if arg_domain:
+            if arg_domain not in EMAIL_DOMAINS:
+                await update.message.reply_text(f"❌ ဤ domain ကို အသုံးမပြုနိုင်ပါ။ ရွေးချယ်နိုင်သော domain များ: {', '.join(EMAIL_DOMAINS)}"); return
+            domain = arg_domain
         if len(arg_name) > 20:
             await update.message.reply_text("❌ Username သည် အက္ခရာ 20 ထက်မပိုရပါ။"); return
         if arg_name.isalnum():
             username = arg_name
-        else:
+        elif arg_name: # "/new @domain" keeps the random name
             await update.message.reply_text("❌ Username ပုံစံမှားယွင်းနေပါသည်။ (a-z, 0-9 သာ)"); return
     
-    # Use EMAIL_DOMAIN for email generation
-    full_address = f"{username}@{EMAIL_DOMAIN}"
-    async with db_lock:
-        try:
-            with get_db_conn() as conn:
-                cursor = conn.cursor()
-                # Check daily limit
-                cursor.execute("SELECT COUNT(*) FROM addresses WHERE user_id = ? AND creation_date = ?", (user_id, datetime.now().date()))
-                if cursor.fetchone()[0] >= DAILY_LIMIT:
-                    await update.message.reply_text(f"⚠️ တစ်နေ့တာအတွက် သတ်မှတ်ထားတဲ့ အီးမေးလ် {DAILY_LIMIT} ခု ပြည့်သွားပါပြီ။"); return
-                
-                # Insert new address
-                cursor.execute("INSERT INTO addresses (user_id, full_address, creation_date) VALUES (?, ?, ?)",
-                               (user_id, full_address, datetime.now().date()))
-                conn.commit()
-                await update.message.reply_text(f"✅ အီးမေးလ်လိပ်စာအသစ် ရပါပြီ:\n\n`{full_address}`", parse_mode=ParseMode.MARKDOWN_V2)
-        except sqlite3.IntegrityError:
-            await update.message.reply_text(f"⚠️ `{full_address}` ဆိုတဲ့လိပ်စာက ရှိပြီးသားဖြစ်နေပါသည်။", parse_mode=ParseMode.MARKDOWN_V2)
-        except Exception as e:
-            logger.error(f"Error in new_email: {e}")
-            await update.message.reply_text("❌ အမှားအယွင်းတစ်ခု ဖြစ်ပွားပါသည်။")
+    full_address = f"{username}@{domain}"
+    try:
+        address_id = await db.write(_create_address, user_id, full_address, datetime.now().date())
+        if address_id is None:
+            await update.message.reply_text(f"⚠️ တစ်နေ့တာအတွက် သတ်မှတ်ထားတဲ့ အီးမေးလ် {DAILY_LIMIT} ခု ပြည့်သွားပါပြီ။"); return
+        address_router.add(full_address, address_id, user_id)
+        admin_stats.address_added(user_id)
+        await update.message.reply_text(f"✅ အီးမေးလ်လိပ်စာအသစ် ရပါပြီ:\n\n`{full_address}`", parse_mode=ParseMode.MARKDOWN_V2)
+    except sqlite3.IntegrityError:
+        await update.message.reply_text(f"⚠️ `{full_address}` ဆိုတဲ့လိပ်စာက ရှိပြီးသားဖြစ်နေပါသည်။", parse_mode=ParseMode.MARKDOWN_V2)
+    except Exception as e:
+        logger.error(f"Error in new_email: {e}")
+        await update.message.reply_text("❌ အမှားအယွင်းတစ်ခု ဖြစ်ပွားပါသည်။")
+
+def _create_address(conn, user_id, full_address, today):
+    """Inserts the address unless the user hit the daily limit; returns its id, or None when over the limit."""
+    # Check daily limit in the same transaction as the insert, so concurrent /new calls cannot overshoot it
+    count = conn.execute(QUERIES['daily_address_count'], (user_id, today)).fetchone()[0]
+    if count >= DAILY_LIMIT:
+        return None
+    return conn.execute(QUERIES['insert_address'], (user_id, full_address, today)).lastrowid
 
 async def my_emails(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     try:
-        async with db_lock:
-            with get_db_conn() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT full_address FROM addresses WHERE user_id = ?", (user_id,))
-                addresses = cursor.fetchall()
+        addresses = await db.fetchall(QUERIES['user_addresses'], (user_id,))
         if not addresses:
             await update.message.reply_text("သင်ဖန်တီးထားတဲ့ အီးမေးလ်လိပ်စာ မရှိသေးပါ။ `/new` ကိုသုံးပြီး အသစ်ဖန်တီးနိုင်ပါတယ်။"); return
         
@@ -186,16 +773,19 @@ async def my_emails(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID: return
     try:
-        async with db_lock:
-            with get_db_conn() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT COUNT(DISTINCT user_id) FROM addresses")
-                user_count = cursor.fetchone()[0]
-                cursor.execute("SELECT COUNT(*) FROM addresses")
-                email_count = cursor.fetchone()[0]
-        db_size_mb = round(os.path.getsize(DB_PATH) / (1024 * 1024), 2) if os.path.exists(DB_PATH) else 0
+        stats = admin_stats.snapshot()
+        db_size_mb = round(stats['db_size_bytes'] / (1024 * 1024), 2)
         
-        text = f"*👑 Admin Panel*\n- 👥 Users: `{user_count}`\n- 📧 Addresses: `{email_count}`\n- 💽 DB Size: `{escape_markdown(str(db_size_mb))} MB`"
+        text = f"*👑 Admin Panel*\n- 👥 Users: `{stats['users']}`\n- 📧 Addresses: `{stats['addresses']}`\n- 📨 Emails: `{stats['emails']}`\n- 💽 DB Size: `{escape_markdown(str(db_size_mb))} MB`"
+        pipeline = stats.get('pipeline')
+        if pipeline:
+            fetch, parse, write, notify = pipeline['fetch'], pipeline['parse'], pipeline['write'], pipeline['notify']
+            imap_avg = fetch['busy_seconds'] / fetch['calls'] if fetch['calls'] else 0
+            text += escape_markdown(
+                f"\n\n📥 Ingest: {write['processed']} stored ({write['per_sec']}/s), {parse['dropped']} dropped, {parse['errors'] + write['errors']} errors"
+                f"\n📦 Queues: parse {parse['queue_depth']}, write {write['queue_depth']}, notify {notify['pending']}"
+                f"\n📡 IMAP: {imap_avg:.2f}s avg, {fetch['last_seconds']}s last"
+                f"\n🔔 Notifications: {notify['sent']} sent, {notify['failed']} failed, {notify['retried']} retried")
         keyboard = [[InlineKeyboardButton("👥 User စာရင်းကြည့်ရန်", callback_data="admin:users")]]
         
         if update.callback_query:
@@ -214,17 +804,15 @@ async def show_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.from_user.id != ADMIN_ID: return
     try:
         await query.answer()
-        async with db_lock:
-            with get_db_conn() as conn:
-                cursor = conn.cursor()
-                cursor.execute("SELECT user_id, COUNT(id) FROM addresses GROUP BY user_id ORDER BY COUNT(id) DESC")
-                users = cursor.fetchall()
+        users = admin_stats.top_users()
         
         if not users: 
             text = "👥 Bot ကိုအသုံးပြုနေသူ မရှိသေးပါ။"
         else: 
             user_lines = [escape_markdown(f"• ID: {uid} (Addresses: {count})") for uid, count in users]
             text = "*👥 Active User List:*\n\n" + "\n".join(user_lines)
+            if admin_stats.users > len(users):
+                text += escape_markdown(f"\n\n… +{admin_stats.users - len(users)} more")
             
         keyboard = [[InlineKeyboardButton("◀️ Admin Panel သို့ပြန်သွားရန်", callback_data="admin:panel")]]
         await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode=ParseMode.MARKDOWN_V2)
@@ -232,127 +820,809 @@ async def show_admin_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in show_admin_users: {e}", exc_info=True)
         await query.answer("❌ User list ကိုပြသရာတွင် အမှားအယွင်းဖြစ်ပွားပါသည်။", show_alert=True)
 
+# --- IMAP SESSION (IDLE PUSH) ---
+class ImapSession:
+    """A long-lived IMAP connection that waits for new mail with IDLE instead of reconnecting to poll."""
+
+    def __init__(self, host, user, password, mailbox="inbox", port=None, ssl=True):
+        self.host, self.user, self.password, self.mailbox = host, user, password, mailbox
+        self.port, self.ssl = port, ssl
+        self.key = f"{user}@{host}/{mailbox}"
+        self.conn = None
+        self.supports_idle = False
+        self.uidvalidity = None
+        self._stopped = threading.Event()
+        # One thread per session: the connection is not thread-safe, and an IDLE wait that holds
+        # a thread for minutes must not starve the shared default executor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"imap-{user}")
+
+    @classmethod
+    def from_account(cls, account):
+        """Builds a session from one IMAP_ACCOUNTS entry."""
+        return cls(account.get('host', IMAP_SERVER), account['user'], account['password'],
+                   account.get('mailbox', "inbox"), account.get('port'), account.get('ssl', True))
+
+    async def run(self, fn, *args):
+        """Runs a blocking call on this session's own thread."""
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def connect(self):
+        """Returns the open connection, logging in and selecting the mailbox if needed."""
+        if self.conn is not None:
+            return self.conn
+        if self.ssl:
+            conn = imaplib.IMAP4_SSL(self.host, self.port or imaplib.IMAP4_SSL_PORT, timeout=IMAP_SOCKET_TIMEOUT)
+        else:
+            # Plain IMAP, e.g. for a local test server
+            conn = imaplib.IMAP4(self.host, self.port or imaplib.IMAP4_PORT, timeout=IMAP_SOCKET_TIMEOUT)
+        try:
+            conn.login(self.user, self.password)
+            conn.select(self.mailbox)
+        except Exception:
+            conn.shutdown()
+            raise
+        self.supports_idle = 'IDLE' in conn.capabilities
+        self.uidvalidity = int(conn.response('UIDVALIDITY')[1][0])
+        # The counts SELECT reports are covered by the fetch that follows; only later ones mean new mail
+        conn.response('EXISTS'), conn.response('RECENT')
+        self.conn = conn
+        logger.info(f"IMAP session opened for {self.key} (IDLE supported: {self.supports_idle})")
+        return conn
+
+    def close(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.logout()
+        except Exception:
+            pass
+        self.conn = None
+
+    def stop(self):
+        """Makes a pending wait_for_mail() return promptly; used on shutdown."""
+        self._stopped.set()
+
+    def wait_for_mail(self, timeout):
+        """Blocks until the server reports new mail or `timeout` seconds pass. Returns True if mail arrived."""
+        conn = self.connect()
+        if not self.supports_idle:
+            self._stopped.wait(IMAP_POLL_INTERVAL)
+            return True
+        # Mail that arrived during the last fetch may already have been announced in a reply to it;
+        # imaplib keeps such untagged responses, and idling now would sleep through them
+        announced = [conn.response(kind)[1][0] for kind in ('EXISTS', 'RECENT')]
+        if any(count not in (None, b'0') for count in announced):
+            return True
+
+        tag = conn._new_tag()
+        try:
+            conn.send(tag + b' IDLE\r\n')
+            # Untagged updates may come before the continuation
+            has_new = False
+            while not (line := conn.readline()).startswith(b'+'):
+                if not line.startswith(b'* '):
+                    raise imaplib.IMAP4.abort(f"IDLE rejected: {line!r}")
+                has_new = has_new or self._is_new_mail(line)
+
+            has_new = has_new or self._wait_idle_event(conn, timeout)
+            conn.send(b'DONE\r\n')
+            while True:
+                line = conn.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+                if line.startswith(tag):
+                    break
+                has_new = has_new or self._is_new_mail(line)
+            if not line[len(tag):].lstrip().startswith(b'OK'):
+                raise imaplib.IMAP4.abort(f"IDLE failed: {line!r}")
+        finally:
+            # _new_tag() registers the tag, but only imaplib's own commands ever clear it
+            conn.tagged_commands.pop(tag, None)
+
+        if not has_new:
+            # Keepalive: surfaces a dead socket now instead of at the next IDLE
+            conn.noop()
+        return has_new
+
+    def _wait_idle_event(self, conn, timeout):
+        deadline = time.monotonic() + timeout
+        while not self._stopped.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            # select() only sees the socket, not what imaplib's reader has already buffered
+            if not self._has_buffered_input(conn):
+                ready, _, _ = select.select([conn.sock], [], [], min(remaining, 1.0))
+                if not ready:
+                    continue
+            line = conn.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if self._is_new_mail(line):
+                return True
+        return False
+
+    @staticmethod
+    def _has_buffered_input(conn):
+        """True if conn.file can return data without waiting on the socket.
+
+        Covers lines that arrived in the same segment as an earlier one, which are already in
+        the BufferedReader, and data already decrypted inside the SSL object.
+        """
+        timeout = conn.sock.gettimeout()
+        conn.sock.settimeout(0)
+        try:
+            # peek() returns buffered bytes as they are, or tries one non-blocking read
+            return bool(conn.file.peek(1))
+        except (BlockingIOError, ssl.SSLWantReadError):
+            return False
+        finally:
+            conn.sock.settimeout(timeout)
+
+    @staticmethod
+    def _is_new_mail(line):
+        return re.match(rb'\* \d+ (EXISTS|RECENT)', line) is not None
+
 # --- BACKGROUND EMAIL FETCHING ---
-def _blocking_imap_check():
-    """Connects to IMAP, fetches unseen emails, marks them as seen, and returns them."""
+def _blocking_imap_check(session: ImapSession, checkpoint, limit=IMAP_FETCH_CHUNK):
+    """Fetches up to `limit` unseen emails past the UID checkpoint, leaving them unseen.
+
+    The whole chunk is fetched with a single UID FETCH (BODY.PEEK[] leaves flags untouched).
+    Returns the raw emails and the UIDs that were requested; a UID expunged in the meantime
+    simply yields no email.
+    """
+    mail = session.connect()
+    if checkpoint and checkpoint[0] == session.uidvalidity:
+        last_uid = checkpoint[1]
+        _, data = mail.uid('SEARCH', f'(UID {last_uid + 1}:* UNSEEN)')
+    else:
+        # First run or the mailbox was recreated (UIDVALIDITY changed): old UIDs mean nothing
+        last_uid = 0
+        _, data = mail.uid('SEARCH', '(UNSEEN)')
+    # "N:*" always matches the highest UID, even when it is below N
+    uids = sorted(uid for uid in map(int, data[0].split()) if uid > last_uid)[:limit]
+    if not uids:
+        return [], []
+
+    _, msg_data = mail.uid('FETCH', ','.join(map(str, uids)), '(UID BODY.PEEK[])')
+    fetched_emails = [item[1] for item in msg_data if isinstance(item, tuple)]
+    return fetched_emails, uids
+
+def _blocking_imap_mark_seen(session: ImapSession, uids):
+    """Marks a chunk as seen on the server in one round trip."""
+    session.connect().uid('STORE', ','.join(map(str, uids)), '+FLAGS.SILENT', '(\\Seen)')
+
+async def _acknowledge_chunk(session: ImapSession, uids, chunk: "IngestChunk"):
+    """Waits until a chunk is committed, then flags it \\Seen and moves the checkpoint past it.
+
+    Raises if any of its emails failed to store: the chunk stays unflagged, and since later chunks
+    are not acknowledged either, the checkpoint stays below it and the next attempt fetches it again.
+    """
+    await chunk.done
+    if chunk.failed:
+        raise RuntimeError(f"{len(uids)} emails fetched from {session.key} were not stored; they will be fetched again")
+    await session.run(_blocking_imap_mark_seen, session, uids)
+    await db.write(save_imap_checkpoint, session.key, session.uidvalidity, uids[-1])
+
+async def fetch_and_process_emails(pipeline: "IngestPipeline", session: ImapSession):
+    """Fetch stage: pulls emails chunk by chunk in a separate thread and feeds them to the pipeline.
+
+    A chunk is flagged and checkpointed only after the writer has committed it, so mail still
+    in the pipeline when the bot stops, or that failed to store, is fetched again. The next
+    chunk is fetched while the previous one is being ingested.
+    """
+    checkpoint = await db.read(load_imap_checkpoint, session.key)
+    in_flight = None
+    while True:
+        started = time.monotonic()
+        raw_emails, uids = await session.run(_blocking_imap_check, session, checkpoint)
+        pipeline.metrics['fetch'].record(len(raw_emails), time.monotonic() - started)
+        fetched = None
+        if uids:
+            logger.info(f"Found {len(raw_emails)} new emails in {session.key}. Processing...")
+            # Blocks while the parse queue is full, so IMAP is never read faster than we can ingest
+            fetched = (uids, await pipeline.submit(raw_emails))
+            checkpoint = (session.uidvalidity, uids[-1])
+        if in_flight:
+            await _acknowledge_chunk(session, *in_flight)
+        in_flight = fetched
+        # Fewer UIDs than asked for means the backlog is drained
+        if len(uids) < IMAP_FETCH_CHUNK:
+            break
+    if in_flight:
+        await _acknowledge_chunk(session, *in_flight)
+
+# --- INGEST PIPELINE ---
+class IngestChunk:
+    """The emails of one IMAP fetch; `done` resolves once each of them is stored, dropped or failed."""
+
+    def __init__(self, size):
+        self.remaining = size
+        self.failed = False
+        self.done = asyncio.get_running_loop().create_future()
+        if not size:
+            self.done.set_result(None)
+
+    def finish(self, count=1, failed=False):
+        self.failed = self.failed or failed
+        self.remaining -= count
+        if self.remaining <= 0 and not self.done.done():
+            self.done.set_result(None)
+
+class ParsedEmail(NamedTuple):
+    message_id: str
+    to_address: str
+    from_address: str
+    subject: str
+    body: str
+    body_blob: bytes = b"" # encode_body(body), filled in instead of body when parsing for storage
+
+class RoutedEmail(NamedTuple):
+    parsed: ParsedEmail
+    address_id: int
+    user_id: int
+
+class NewEmail(NamedTuple):
+    email_id: int
+    user_id: int
+    from_address: str
+    subject: str
+    outbox_id: int
+
+def _decode_part(part):
     try:
-        with imaplib.IMAP4_SSL(IMAP_SERVER) as mail:
-            mail.login(CATCH_ALL_EMAIL, CATCH_ALL_PASSWORD)
-            mail.select("inbox")
-            _, messages = mail.search(None, '(UNSEEN)')
-            email_ids_bytes = messages[0].split()
-            if not email_ids_bytes:
-                return []
-
-            fetched_emails = []
-            for mail_id in email_ids_bytes:
-                _, msg_data = mail.fetch(mail_id, "(RFC822)")
-                fetched_emails.append(msg_data[0][1])
-                # Mark the email as seen on the server
-                mail.store(mail_id, '+FLAGS', '\\Seen')
-            return fetched_emails
-    except Exception as e:
-        logger.error(f"Blocking IMAP check failed: {e}")
-        return []
-
-async def fetch_and_process_emails(application: Application):
-    """Fetches emails in a separate thread and processes them."""
-    raw_emails = await asyncio.to_thread(_blocking_imap_check)
-    if not raw_emails:
-        return
-    
-    logger.info(f"Found {len(raw_emails)} new emails. Processing...")
-    async with db_lock:
-        with get_db_conn() as conn:
-            for raw_email_data in raw_emails:
+        return part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', 'ignore')
+    except (UnicodeDecodeError, AttributeError, LookupError):
+        return "[Could not decode email content]"
+
+def parse_raw_email(raw_email_data, encode=False):
+    """Decodes a raw message into a ParsedEmail, or returns None if it is not for one of our addresses.
+
+    Runs in the parser process pool, so it must stay a picklable module-level function. With
+    `encode`, the body is compressed here too and returned only as body_blob.
+    """
+    msg = email.message_from_bytes(raw_email_data)
+
+    message_id_header = msg.get("Message-ID")
+    if not message_id_header:
+        return None # Skip if no message-id to prevent duplicates
+
+    to_header = msg.get("To") or msg.get("Delivered-To") or ""
+    to_address = email.utils.parseaddr(to_header)[1].lower()
+    if not to_address or to_address.rpartition('@')[2] not in EMAIL_DOMAINS:
+        return None
+
+    # Decode subject and from address properly
+    subject_header = decode_header(msg["Subject"])[0]
+    from_header = decode_header(msg.get("From"))[0]
+
+    subject = subject_header[0].decode(subject_header[1] or 'utf-8', 'ignore') if isinstance(subject_header[0], bytes) else subject_header[0]
+    from_address = from_header[0].decode(from_header[1] or 'utf-8', 'ignore') if isinstance(from_header[0], bytes) else from_header[0]
+
+    if not from_address or from_address.isspace():
+        from_address = "Unknown Sender"
+
+    body = None
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_type() == "text/plain":
+                body = _decode_part(part)
+                break
+    else:
+        body = _decode_part(msg)
+
+    if encode:
+        return ParsedEmail(message_id_header, to_address, from_address, subject or "", "", encode_body(body or ""))
+    return ParsedEmail(message_id_header, to_address, from_address, subject or "", body or "")
+
+def _store_emails(conn, batch):
+    """Inserts a batch of routed emails on the writer connection and returns the ones that were new."""
+    stored = []
+    cursor = conn.cursor()
+    for parsed, address_id, user_id in batch:
+        # The UNIQUE message_id turns already-processed emails into no-ops
+        try:
+            cursor.execute(QUERIES['insert_email'], (address_id, parsed.message_id, parsed.from_address, parsed.subject, datetime.now()))
+        except sqlite3.IntegrityError:
+            # The address expired between routing and this write
+            continue
+        if cursor.rowcount:
+            email_id = cursor.lastrowid
+            cursor.execute(QUERIES['insert_email_body'], (email_id, parsed.body_blob or encode_body(parsed.body)))
+            # Queued in the same transaction, so a stored email is never left without its notification
+            cursor.execute(QUERIES['insert_outbox'], (email_id, user_id))
+            stored.append(NewEmail(email_id, user_id, parsed.from_address, parsed.subject, cursor.lastrowid))
+    return stored
+
+class StageMetrics:
+    """Throughput and queue-depth counters for one pipeline stage."""
+
+    def __init__(self, queue=None):
+        self.queue = queue
+        self.processed = 0
+        self.errors = 0
+        self.dropped = 0
+        self.busy_seconds = 0.0
+        self.calls = 0
+        self.last_seconds = 0.0
+        self.started = time.monotonic()
+
+    def record(self, count, seconds):
+        self.processed += count
+        self.busy_seconds += seconds
+        self.calls += 1
+        self.last_seconds = seconds
+
+    def snapshot(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            'processed': self.processed,
+            'errors': self.errors,
+            'dropped': self.dropped,
+            'per_sec': round(self.processed / elapsed, 2),
+            'busy_seconds': round(self.busy_seconds, 2),
+            'calls': self.calls,
+            'last_seconds': round(self.last_seconds, 3),
+            'queue_depth': self.queue.qsize() if self.queue is not None else 0,
+        }
+
+def create_parse_executor(processes=PARSE_PROCESSES):
+    """Returns the process pool for MIME parsing, or None to parse in the default thread pool."""
+    if processes <= 0:
+        return None
+    # "spawn" because the bot process already runs threads (Flask, httpx) that must not be forked
+    return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'))
+
+class IngestPipeline:
+    """fetch -> parse (process pool) -> batched DB writer -> notification dispatcher, joined by bounded queues.
+
+    A slow Telegram call only grows the dispatcher's backlog; DB writes and bot queries keep going
+    until that backlog is full, and only then does backpressure reach the IMAP fetch stage.
+    """
+
+    def __init__(self, dispatcher: "NotificationDispatcher"):
+        self.dispatcher = dispatcher
+        self.parse_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.write_queue = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self.metrics = {
+            'fetch': StageMetrics(),
+            'parse': StageMetrics(self.parse_queue),
+            'write': StageMetrics(self.write_queue),
+        }
+        self._tasks = []
+        self.parse_executor = None
+
+    def start(self):
+        self.parse_executor = create_parse_executor()
+        # Keep at least one in-flight parse per process so every core stays busy
+        self._tasks = [asyncio.create_task(self._parse_worker()) for _ in range(max(PARSE_WORKERS, PARSE_PROCESSES))]
+        self._tasks.append(asyncio.create_task(self._db_writer()))
+        self._tasks.append(asyncio.create_task(self._log_stats()))
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+        if self.parse_executor:
+            self.parse_executor.shutdown(wait=False, cancel_futures=True)
+
+    async def drain(self, timeout=INGEST_DRAIN_TIMEOUT):
+        """Waits up to `timeout` seconds for queued emails to be stored; returns False if some are left."""
+        async def join():
+            # Parse workers queue for the writer before marking their item done, so this order is enough
+            await self.parse_queue.join()
+            await self.write_queue.join()
+        try:
+            await asyncio.wait_for(join(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def stats(self):
+        stats = {name: metrics.snapshot() for name, metrics in self.metrics.items()}
+        stats['notify'] = self.dispatcher.stats()
+        return stats
+
+    async def submit(self, raw_emails):
+        """Queues a fetched chunk for parsing and returns its IngestChunk."""
+        chunk = IngestChunk(len(raw_emails))
+        for raw_email_data in raw_emails:
+            await self.parse_queue.put((raw_email_data, chunk))
+        return chunk
+
+    async def _parse_worker(self):
+        metrics = self.metrics['parse']
+        while True:
+            raw_email_data, chunk = await self.parse_queue.get()
+            started = time.monotonic()
+            try:
+                parsed = await asyncio.get_running_loop().run_in_executor(
+                    self.parse_executor, parse_raw_email, raw_email_data, True)
+                routed = self._route(parsed) if parsed else None
+                if routed:
+                    await self.write_queue.put((routed, chunk))
+                else:
+                    metrics.dropped += 1
+                    chunk.finish()
+            except Exception as e:
+                metrics.errors += 1
+                chunk.finish()
+                logger.error(f"Error parsing email: {e}", exc_info=True)
+            finally:
+                metrics.record(1, time.monotonic() - started)
+                self.parse_queue.task_done()
+
+    @staticmethod
+    def _route(parsed):
+        """Resolves the owner of a parsed email, or returns None for unknown recipients and duplicates."""
+        route = address_router.lookup(parsed.to_address)
+        if route is None or parsed.message_id in recent_message_ids:
+            return None
+        return RoutedEmail(parsed, *route)
+
+    async def _db_writer(self):
+        metrics = self.metrics['write']
+        while True:
+            # Group whatever is already waiting into one transaction
+            batch = [await self.write_queue.get()]
+            while len(batch) < DB_BATCH_SIZE and not self.write_queue.empty():
+                batch.append(self.write_queue.get_nowait())
+            started = time.monotonic()
+            failed = False
+            try:
+                stored = await db.write(_store_emails, [routed for routed, _ in batch])
+                # Stored now, or already stored before (INSERT OR IGNORE); either way a re-delivery is a duplicate
+                for routed, _ in batch:
+                    recent_message_ids.add(routed.parsed.message_id)
+                metrics.record(len(batch), time.monotonic() - started)
+                admin_stats.emails_added(len(stored))
+                for new_email in stored:
+                    await self.dispatcher.put(new_email)
+            except Exception as e:
+                failed = True
+                metrics.errors += len(batch)
+                logger.error(f"Error storing batch of {len(batch)} emails in DB: {e}", exc_info=True)
+            finally:
+                # A failed chunk is left unacknowledged on the server, so it is fetched and written again.
+                # Parse errors are not retried: the same message would fail the same way every time
+                for _, chunk in batch:
+                    chunk.finish(failed=failed)
+                    self.write_queue.task_done()
+
+    async def _log_stats(self):
+        while True:
+            await asyncio.sleep(PIPELINE_STATS_INTERVAL)
+            logger.info(f"Ingest pipeline stats: {self.stats()}")
+
+# --- NOTIFICATION DISPATCHER ---
+class RateLimiter:
+    """Token bucket shared by concurrent senders; pause() holds everyone back after a flood-wait."""
+
+    def __init__(self, rate, burst=1):
+        self.rate, self.burst = rate, burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+def _delete_outbox(conn, outbox_ids):
+    conn.executemany(QUERIES['delete_outbox'], [(outbox_id,) for outbox_id in outbox_ids])
+
+def _load_outbox(conn):
+    rows = conn.execute(
+        "SELECT o.email_id, o.chat_id, e.from_address, e.subject, o.id FROM outbox o JOIN emails e ON e.id = o.email_id ORDER BY o.id"
+    ).fetchall()
+    return [NewEmail(*row) for row in rows]
+
+def build_notification(items):
+    """Returns (text, keyboard) for one email, or a digest when several arrived for the same chat."""
+    if len(items) == 1:
+        new_email = items[0]
+        # Use APP_HOST_DOMAIN for the view link
+        view_url = f"https://{APP_HOST_DOMAIN}/view_email/{new_email.email_id}"
+        escaped_from = escape_markdown(new_email.from_address)
+        escaped_subject = escape_markdown(new_email.subject)
+        text = f"📧 *စာအသစ်ရောက်ရှိပါသည်*\n\n*From:* {escaped_from}\n*Subject:* {escaped_subject}"
+        return text, [[InlineKeyboardButton("📖 Browser တွင်ဖွင့်ဖတ်ရန်", url=view_url)]]
+
+    lines = [f"📬 *စာအသစ် {len(items)} စောင် ရောက်ရှိပါသည်*"]
+    buttons = []
+    for number, new_email in enumerate(items, start=1):
+        # Trimmed so a full digest stays well under Telegram's 4096 character limit
+        escaped_from = escape_markdown(new_email.from_address[:80])
+        escaped_subject = escape_markdown(new_email.subject[:120])
+        lines.append(f"\n*{number}\\.* *From:* {escaped_from}\n*Subject:* {escaped_subject}")
+        buttons.append(InlineKeyboardButton(f"📖 {number}", url=f"https://{APP_HOST_DOMAIN}/view_email/{new_email.email_id}"))
+    keyboard = [buttons[i:i + 5] for i in range(0, len(buttons), 5)]
+    return "\n".join(lines), keyboard
+
+class NotificationDispatcher:
+    """Delivers new-email notifications from the persistent outbox at Telegram's rate limits.
+
+    Emails waiting for the same chat are coalesced into one digest message, up to
+    NOTIFY_CONCURRENCY chats are sent to at once, flood-waits pause all sending, and network
+    errors are retried with backoff. Rows leave the outbox only once delivered or given up on.
+    """
+
+    def __init__(self, application: Application):
+        self.application = application
+        self._pending = {} # chat_id -> [NewEmail]
+        self._pending_count = 0
+        self._next_send = {} # chat_id -> monotonic time its next message may go out
+        self._attempts = {} # outbox_id -> failed attempts so far
+        self._in_flight = set()
+        self._limiter = RateLimiter(NOTIFY_GLOBAL_RATE, burst=max(1, int(NOTIFY_GLOBAL_RATE)))
+        self._slots = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._task = None
+        self.sent = self.messages = self.failed = self.retried = 0
+
+    async def start(self):
+        for new_email in await db.read(_load_outbox):
+            self._add(new_email)
+        if self._pending_count:
+            logger.info(f"Resuming {self._pending_count} undelivered notifications from the outbox")
+        self._task = asyncio.create_task(self._run())
+
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'messages': self.messages,
+            'failed': self.failed,
+            'retried': self.retried,
+            'pending': self._pending_count,
+            'queue_depth': len(self._pending),
+        }
+
+    async def put(self, new_email: NewEmail):
+        """Queues a notification, waiting while the in-memory backlog is full."""
+        async with self._space:
+            await self._space.wait_for(lambda: self._pending_count < NOTIFY_MAX_PENDING)
+            self._add(new_email)
+
+    def _add(self, new_email):
+        self._pending.setdefault(new_email.user_id, []).append(new_email)
+        self._pending_count += 1
+        self._wakeup.set()
+
+    async def _run(self):
+        while True:
+            now = time.monotonic()
+            for chat_id in [c for c, at in self._next_send.items() if at <= now and c not in self._pending]:
+                del self._next_send[chat_id]
+            waiting = [chat_id for chat_id in self._pending if chat_id not in self._in_flight]
+            ready = [chat_id for chat_id in waiting if self._next_send.get(chat_id, 0) <= now]
+            if not ready:
+                # Sleep until a chat's per-chat interval ends or something new is queued
+                delays = [self._next_send[chat_id] - now for chat_id in waiting if chat_id in self._next_send]
+                self._wakeup.clear()
                 try:
-                    msg = email.message_from_bytes(raw_email_data)
-                    
-                    message_id_header = msg.get("Message-ID")
-                    if not message_id_header:
-                        continue # Skip if no message-id to prevent duplicates
-
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT id FROM emails WHERE message_id = ?", (message_id_header,))
-                    if cursor.fetchone():
-                        continue # Already processed
-
-                    to_header = msg.get("To") or msg.get("Delivered-To") or ""
-                    to_address = email.utils.parseaddr(to_header)[1].lower()
-                    
-                    if not to_address or not to_address.endswith(f"@{EMAIL_DOMAIN}"):
-                        continue
-
-                    cursor.execute("SELECT id, user_id FROM addresses WHERE full_address = ?", (to_address,))
-                    address_row = cursor.fetchone()
-
-                    if address_row:
-                        address_id, user_id = address_row
-                        
-                        # Decode subject and from address properly
-                        subject_header = decode_header(msg["Subject"])[0]
-                        from_header = decode_header(msg.get("From"))[0]
-                        
-                        subject = subject_header[0].decode(subject_header[1] or 'utf-8', 'ignore') if isinstance(subject_header[0], bytes) else subject_header[0]
-                        from_address = from_header[0].decode(from_header[1] or 'utf-8', 'ignore') if isinstance(from_header[0], bytes) else from_header[0]
-
-                        if not from_address or from_address.isspace():
-                            from_address = "Unknown Sender"
-
-                        body = ""
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                if part.get_content_type() == "text/plain":
-                                    try:
-                                        body = part.get_payload(decode=True).decode(part.get_content_charset() or 'utf-8', 'ignore')
-                                        break
-                                    except (UnicodeDecodeError, AttributeError):
-                                        body = "[Could not decode email content]"
-                        else:
-                            try:
-                                body = msg.get_payload(decode=True).decode(msg.get_content_charset() or 'utf-8', 'ignore')
-                            except (UnicodeDecodeError, AttributeError):
-                                body = "[Could not decode email content]"
-
-                        cursor.execute("INSERT INTO emails (address_id, message_id, from_address, subject, body, received_at) VALUES (?, ?, ?, ?, ?, ?)", 
-                                       (address_id, message_id_header, from_address, subject, body, datetime.now()))
-                        new_db_email_id = cursor.lastrowid
-                        conn.commit()
-
-                        # Use APP_HOST_DOMAIN for the view link
-                        view_url = f"https://{APP_HOST_DOMAIN}/view_email/{new_db_email_id}"
-                        
-                        escaped_from = escape_markdown(from_address)
-                        escaped_subject = escape_markdown(subject)
-                        
-                        notification_text = f"📧 *စာအသစ်ရောက်ရှိပါသည်*\n\n*From:* {escaped_from}\n*Subject:* {escaped_subject}"
-                        keyboard = [[InlineKeyboardButton("📖 Browser တွင်ဖွင့်ဖတ်ရန်", url=view_url)]]
-                        
-                        try:
-                            await application.bot.send_message(
-                                chat_id=user_id, 
-                                text=notification_text, 
-                                reply_markup=InlineKeyboardMarkup(keyboard), 
-                                parse_mode=ParseMode.MARKDOWN_V2
-                            )
-                        except BadRequest as e:
-                            logger.error(f"Failed to send notification to {user_id}: {e}")
+                    await asyncio.wait_for(self._wakeup.wait(), min(delays) if delays else None)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for chat_id in ready:
+                await self._slots.acquire()
+                items = self._pending.pop(chat_id)
+                if len(items) > NOTIFY_DIGEST_MAX:
+                    self._pending[chat_id] = items[NOTIFY_DIGEST_MAX:]
+                    items = items[:NOTIFY_DIGEST_MAX]
+                self._in_flight.add(chat_id)
+                asyncio.create_task(self._send(chat_id, items))
 
-                except Exception as e:
-                    logger.error(f"Error processing single email in DB: {e}", exc_info=True)
+    async def _send(self, chat_id, items):
+        outbox_ids = [new_email.outbox_id for new_email in items]
+        try:
+            await self._limiter.acquire()
+            text, keyboard = build_notification(items)
+            await self.application.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                parse_mode=ParseMode.MARKDOWN_V2
+            )
+            self.sent += len(items)
+            self.messages += 1
+            self._next_send[chat_id] = time.monotonic() + NOTIFY_CHAT_INTERVAL
+            await self._finish(outbox_ids)
+        except RetryAfter as e:
+            retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+            logger.warning(f"Flood control hit, pausing notifications for {retry_after}s")
+            self._limiter.pause(retry_after)
+            self._retry(chat_id, items, retry_after, count_attempt=False)
+        except (BadRequest, Forbidden) as e:
+            # The chat is gone or the message is invalid; retrying cannot help
+            logger.error(f"Failed to send notification to {chat_id}: {e}")
+            self.failed += len(items)
+            await self._finish(outbox_ids)
+        except Exception as e:
+            attempts = max(self._attempts.get(outbox_id, 0) for outbox_id in outbox_ids) + 1
+            if attempts >= NOTIFY_MAX_ATTEMPTS:
+                logger.error(f"Giving up on notification to {chat_id} after {attempts} attempts: {e}")
+                self.failed += len(items)
+                await self._finish(outbox_ids)
+            else:
+                logger.warning(f"Notification to {chat_id} failed (attempt {attempts}), retrying: {e}")
+                self._retry(chat_id, items, min(2 ** attempts, 60))
+        finally:
+            self._in_flight.discard(chat_id)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _retry(self, chat_id, items, delay, count_attempt=True):
+        self.retried += len(items)
+        if count_attempt:
+            for new_email in items:
+                self._attempts[new_email.outbox_id] = self._attempts.get(new_email.outbox_id, 0) + 1
+        # Put the batch back in front of anything that arrived meanwhile
+        self._pending[chat_id] = items + self._pending.get(chat_id, [])
+        self._next_send[chat_id] = time.monotonic() + delay
+
+    async def _finish(self, outbox_ids):
+        for outbox_id in outbox_ids:
+            self._attempts.pop(outbox_id, None)
+        async with self._space:
+            self._pending_count -= len(outbox_ids)
+            self._space.notify_all()
+        try:
+            await db.write(_delete_outbox, outbox_ids)
+        except Exception as e:
+            logger.error(f"Could not clear delivered notifications from the outbox: {e}")
+
+# --- RETENTION ---
+def _purge_emails(conn, cutoff, limit):
+    """Deletes up to `limit` emails received before `cutoff` and returns their ids."""
+    ids = [row[0] for row in conn.execute(QUERIES['expired_emails'], (cutoff, limit))]
+    conn.executemany("DELETE FROM emails WHERE id = ?", [(email_id,) for email_id in ids])
+    return ids
+
+def _purge_addresses(conn, cutoff, limit):
+    """Deletes up to `limit` addresses created before `cutoff`, cascading to their emails.
+
+    Returns the deleted (full_address, user_id) pairs and the ids of the emails that went with them.
+    """
+    rows = conn.execute(QUERIES['expired_addresses'], (cutoff, limit)).fetchall()
+    email_ids = []
+    for address_id, _, _ in rows:
+        email_ids.extend(row[0] for row in conn.execute("SELECT id FROM emails WHERE address_id = ?", (address_id,)))
+    conn.executemany("DELETE FROM addresses WHERE id = ?", [(address_id,) for address_id, _, _ in rows])
+    return [(full_address, user_id) for _, full_address, user_id in rows], email_ids
+
+def _incremental_vacuum(conn, pages):
+    """Returns up to `pages` free pages to the filesystem; returns (bytes reclaimed, free pages left)."""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return (before - after) * page_size, after
+
+class RetentionEngine:
+    """Expires emails and addresses past their TTL and shrinks the database file afterwards.
+
+    Deletes go through the shared writer RETENTION_BATCH rows at a time, so ingest and /new
+    writes interleave with a purge instead of waiting for it to finish.
+    """
+
+    def __init__(self):
+        self.emails_purged = 0
+        self.addresses_purged = 0
+        self.bytes_reclaimed = 0
+        self.last_run = None
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
 
-async def background_tasks_loop(application: Application):
-    logger.info("Background tasks loop started.")
+    def close(self):
+        if self._task:
+            self._task.cancel()
+
+    def stats(self):
+        return {
+            'emails_purged': self.emails_purged,
+            'addresses_purged': self.addresses_purged,
+            'bytes_reclaimed': self.bytes_reclaimed,
+            'last_run': self.last_run.isoformat(timespec='seconds') if self.last_run else None,
+        }
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception as e:
+                logger.error(f"Retention run failed: {e}", exc_info=True)
+            await asyncio.sleep(RETENTION_INTERVAL)
+
+    async def run_once(self):
+        emails, addresses = 0, 0
+        if EMAIL_TTL_DAYS:
+            cutoff = datetime.now() - timedelta(days=EMAIL_TTL_DAYS)
+            while True:
+                email_ids = await db.write(_purge_emails, cutoff, RETENTION_BATCH)
+                self._forget_emails(email_ids)
+                emails += len(email_ids)
+                if len(email_ids) < RETENTION_BATCH:
+                    break
+        if ADDRESS_TTL_DAYS:
+            cutoff = datetime.now().date() - timedelta(days=ADDRESS_TTL_DAYS)
+            while True:
+                removed, email_ids = await db.write(_purge_addresses, cutoff, RETENTION_BATCH)
+                for full_address, user_id in removed:
+                    address_router.remove(full_address)
+                    admin_stats.address_removed(user_id)
+                self._forget_emails(email_ids)
+                addresses += len(removed)
+                emails += len(email_ids)
+                if len(removed) < RETENTION_BATCH:
+                    break
+
+        reclaimed = 0
+        while True:
+            freed, remaining = await db.write(_incremental_vacuum, VACUUM_PAGES)
+            reclaimed += freed
+            if not remaining or not freed:
+                break
+
+        self.emails_purged += emails
+        self.addresses_purged += addresses
+        self.bytes_reclaimed += reclaimed
+        self.last_run = datetime.now()
+        if emails or addresses or reclaimed:
+            logger.info(f"Retention: purged {emails} emails and {addresses} addresses, reclaimed {reclaimed / (1024 * 1024):.2f} MB")
+
+    @staticmethod
+    def _forget_emails(email_ids):
+        admin_stats.emails_removed(len(email_ids))
+        for email_id in email_ids:
+            email_page_cache.discard(email_id)
+
+async def background_tasks_loop(pipeline: IngestPipeline, session: ImapSession):
+    """Ingest worker for one mailbox; one runs per IMAP_ACCOUNTS entry, all feeding the shared pipeline."""
+    logger.info(f"Background tasks loop started for {session.key}.")
+    backoff = 1
     while True:
         try:
-            await fetch_and_process_emails(application)
+            await fetch_and_process_emails(pipeline, session)
+            # Wait (off the event loop) until the server pushes new mail or the IDLE period ends
+            await session.run(session.wait_for_mail, IMAP_IDLE_TIMEOUT)
+            backoff = 1
         except Exception as e:
-            logger.error(f"Error in background_tasks_loop: {e}", exc_info=True)
-        # Check for emails every 45 seconds
-        await asyncio.sleep(45)
+            logger.error(f"Error in background_tasks_loop for {session.key}: {e}", exc_info=True)
+            await session.run(session.close)
+            logger.info(f"Reconnecting to IMAP {session.key} in {backoff}s...")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, IMAP_MAX_BACKOFF)
 
 async def post_init(application: Application):
     """Post-initialization function to set up commands and background tasks."""
+    db.start()
+    await db.read(address_router.load)
+    await db.read(admin_stats.load)
+    if WEB_SERVER == 'asgi':
+        web_server = create_asgi_server()
+        application.bot_data['web_server'] = (web_server, asyncio.create_task(web_server.serve()))
+
     commands = [
         BotCommand("start", "Bot ကိုစတင်ရန်"),
         BotCommand("new", "Email အသစ်ဖန်တီးရန်"),
@@ -368,19 +1638,100 @@ async def post_init(application: Application):
         except Exception as e:
             logger.warning(f"Could not set admin commands for chat {ADMIN_ID}: {e}")
 
-    # Start the background task
-    asyncio.create_task(background_tasks_loop(application))
+    # Start the notification dispatcher, the ingest pipeline and one fetch loop per mailbox,
+    # each with an IMAP session reused across cycles
+    dispatcher = NotificationDispatcher(application)
+    await dispatcher.start()
+    application.bot_data['dispatcher'] = dispatcher
+    pipeline = IngestPipeline(dispatcher)
+    pipeline.start()
+    retention = RetentionEngine()
+    retention.start()
+    application.bot_data['retention'] = retention
+    application.bot_data['pipeline'] = pipeline
+    admin_stats.pipeline, admin_stats.retention = pipeline, retention
+    sessions = [ImapSession.from_account(account) for account in IMAP_ACCOUNTS]
+    application.bot_data['imap_sessions'] = sessions
+    application.bot_data['imap_workers'] = [asyncio.create_task(background_tasks_loop(pipeline, session)) for session in sessions]
 
-def main():
-    """Start the bot."""
-    # Initialize the database
-    init_db()
-    
-    # Start the Flask web server in a background thread
-    start_web_server_in_thread()
+async def post_shutdown(application: Application):
+    """Stops the web server and fetching, lets the pipeline store what it already holds, and wakes a pending IDLE wait."""
+    if 'web_server' in application.bot_data:
+        # Closes the listening socket and finishes in-flight requests before the loop goes away
+        web_server, serving = application.bot_data.pop('web_server')
+        web_server.should_exit = True
+        await serving
+    for worker in application.bot_data.get('imap_workers', []):
+        worker.cancel()
+    for session in application.bot_data.get('imap_sessions', []):
+        session.stop()
+    pipeline = application.bot_data.get('pipeline')
+    if pipeline:
+        if not await pipeline.drain():
+            # Their chunks were never flagged or checkpointed, so the next start fetches them again
+            logger.warning(f"Shutting down with {pipeline.parse_queue.qsize() + pipeline.write_queue.qsize()} emails not yet stored")
+        pipeline.close()
+    dispatcher = application.bot_data.get('dispatcher')
+    if dispatcher:
+        dispatcher.close()
+    retention = application.bot_data.get('retention')
+    if retention:
+        retention.close()
+    db.close()
 
-    # Set up the Telegram bot application
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+# --- TELEGRAM WEBHOOK ---
+@app.route(WEBHOOK_PATH, methods=['POST'])
+def telegram_webhook():
+    """Receives an update from Telegram and hands it to the bot's update queue."""
+    application = app.config.get('BOT_APPLICATION')
+    if application is None:
+        return "Webhook mode is not active", 503
+    token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+    if not hmac.compare_digest(token, WEBHOOK_SECRET):
+        return "Forbidden", 403
+    update = Update.de_json(request.get_json(force=True), application.bot)
+    # Flask views run in worker threads; the queue belongs to the bot's event loop
+    asyncio.run_coroutine_threadsafe(application.update_queue.put(update), app.config['BOT_LOOP'])
+    return "", 200
+
+def attach_webhook(application: Application, loop):
+    """Routes updates posted to WEBHOOK_PATH into `application`, which runs on `loop`."""
+    app.config['BOT_LOOP'] = loop
+    app.config['BOT_APPLICATION'] = application
+
+async def run_webhook(application: Application):
+    """Runs the bot on updates Telegram posts to the web server, until SIGINT/SIGTERM."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    # The same lifecycle run_polling() drives, minus the Updater
+    await application.initialize()
+    try:
+        await application.post_init(application)
+        await application.start()
+        attach_webhook(application, loop)
+        await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Webhook registered at {WEBHOOK_URL}")
+        await stop.wait()
+    finally:
+        app.config.pop('BOT_APPLICATION', None)
+        if application.running:
+            await application.stop()
+        await application.shutdown()
+        await application.post_shutdown(application)
+
+def build_application(request=None):
+    """Builds the bot Application with all handlers; `request` swaps the HTTP layer (used by benchmarks)."""
+    builder = Application.builder().token(BOT_TOKEN).post_init(post_init).post_shutdown(post_shutdown)
+    builder = builder.base_url(f"{TELEGRAM_API_URL}/bot")
+    if BOT_MODE == 'webhook':
+        # No Updater: updates arrive through the web server, and are handled concurrently
+        builder = builder.updater(None).concurrent_updates(True)
+    if request is not None:
+        builder = builder.request(request)
+    application = builder.build()
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -390,10 +1741,27 @@ def main():
     application.add_handler(CommandHandler("admin", admin_panel))
     application.add_handler(CallbackQueryHandler(show_admin_users, pattern=r'^admin:users'))
     application.add_handler(CallbackQueryHandler(admin_panel, pattern=r'^admin:panel'))
+    return application
+
+def main():
+    """Start the bot."""
+    # Initialize the database
+    init_db()
+    
+    # Start the Flask web server in a background thread; in ASGI mode post_init serves it on the bot's loop instead
+    if WEB_SERVER != 'asgi':
+        start_web_server_in_thread()
+
+    # Set up the Telegram bot application
+    application = build_application()
 
-    # Start polling
-    logger.info("Bot is starting to poll...")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        logger.info("Bot is starting in webhook mode...")
+        asyncio.run(run_webhook(application))
+    else:
+        # Start polling
+        logger.info("Bot is starting to poll...")
+        application.run_polling()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,84 @@
+# Shared fixtures: the bot module imported offline with a fresh database per test, and the fake
+# IMAP server from benchmarks/ standing in for the catch-all mailboxes.
+
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+# Read once at import: two domains, parsing in threads, and chunks small enough to need several fetches
+os.environ.update({'EMAIL_DOMAINS': 'a.test,b.test', 'PARSE_PROCESSES': '0', 'IMAP_FETCH_CHUNK': '5'})
+
+from common import import_main, make_message  # noqa: E402
+from fake_imap import FakeImapServer  # noqa: E402
+from fake_telegram import FakeBotApiServer  # noqa: E402
+
+bot = import_main()
+
+MAILBOXES = ['box0@mail.test', 'box1@mail.test']
+
+class CollectingDispatcher:
+    """Stands in for the notification dispatcher and keeps every email the writer hands it."""
+
+    def __init__(self):
+        self.emails = []
+        self.changed = asyncio.Event()
+
+    async def put(self, new_email):
+        self.emails.append(new_email)
+        self.changed.set()
+
+    async def wait_for(self, count, timeout=10):
+        async def wait():
+            while len(self.emails) < count:
+                self.changed.clear()
+                await self.changed.wait()
+        await asyncio.wait_for(wait(), timeout)
+
+    def stats(self):
+        return {}
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    """The bot module with its own database and empty in-memory caches."""
+    monkeypatch.setattr(bot, 'DB_PATH', str(tmp_path / 'test.db'))
+    fresh_state(monkeypatch)
+    bot.init_db()
+    return bot
+
+def fresh_state(monkeypatch):
+    """Replaces the module-level singletons, as a restart of the bot process would."""
+    monkeypatch.setattr(bot, 'db', bot.Database())
+    monkeypatch.setattr(bot, 'address_router', bot.AddressRouter())
+    monkeypatch.setattr(bot, 'recent_message_ids', bot.RecentMessageIds())
+    monkeypatch.setattr(bot, 'admin_stats', bot.AdminStats())
+
+@pytest.fixture
+def imap():
+    with FakeImapServer({user: 'secret' for user in MAILBOXES}) as server:
+        yield server
+
+@pytest.fixture
+def bot_api(main, monkeypatch):
+    """The stub Bot API, with the bot pointed at it; `sent` collects every sendMessage."""
+    with FakeBotApiServer() as server:
+        server.sent = []
+        server.on_message = lambda chat_id, text, reply_markup, received: server.sent.append(
+            {'chat_id': chat_id, 'text': text, 'reply_markup': reply_markup})
+        monkeypatch.setattr(bot, 'TELEGRAM_API_URL', server.url)
+        yield server
+
+def open_session(imap, user=MAILBOXES[0]):
+    return bot.ImapSession('127.0.0.1', user, 'secret', port=imap.port, ssl=False)
+
+def create_address(full_address, user_id):
+    """Stores an address and registers its route, like /new does."""
+    with bot.get_db_conn() as conn:
+        address_id = conn.execute(bot.QUERIES['insert_address'], (user_id, full_address, '2026-01-01')).lastrowid
+    bot.address_router.add(full_address, address_id, user_id)
+
+def deliver(imap, user, number, to_address):
+    return imap.deliver(user, make_message(number, to_address, body_words=20, html=False))
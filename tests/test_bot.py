@@ -0,0 +1,42 @@
+import asyncio
+import re
+
+import pytest
+from telegram import Update
+
+from common import make_command_update
+
+def run_command(main, command, user_id=7):
+    """Sends one command update through the bot's handlers against the stub Bot API."""
+    async def scenario():
+        main.db.start()
+        application = main.build_application()
+        await application.initialize()
+        try:
+            await application.process_update(Update.de_json(make_command_update(1, user_id, command), application.bot))
+        finally:
+            await application.shutdown()
+            main.db.close()
+
+    asyncio.run(scenario())
+    with main.get_db_conn() as conn:
+        return [row[0] for row in conn.execute(main.QUERIES['user_addresses'], (user_id,))]
+
+@pytest.mark.parametrize('command, expected', [
+    ('/new alice@b.test', 'alice@b.test'),
+    ('/new Bob b.test', 'bob@b.test'),
+    ('/new carol', r'carol@(a|b)\.test'),
+    ('/new @b.test', r'[a-z0-9]{8}@b\.test'),
+    ('/new', r'[a-z0-9]{8}@(a|b)\.test'),
+])
+def test_new_creates_the_requested_address(main, bot_api, command, expected):
+    addresses = run_command(main, command)
+    assert len(addresses) == 1
+    assert re.fullmatch(expected, addresses[0])
+    assert main.address_router.lookup(addresses[0]) is not None
+    assert addresses[0] in bot_api.sent[-1]['text']
+
+@pytest.mark.parametrize('command', ['/new dave@elsewhere.test', '/new dave elsewhere.test', '/new da.ve@a.test'])
+def test_new_rejects_unknown_domains_and_bad_names(main, bot_api, command):
+    assert run_command(main, command) == []
+    assert bot_api.sent[-1]['text'].startswith('❌')
@@ -0,0 +1,81 @@
+import asyncio
+import time
+
+from conftest import bot, create_address
+
+def store_emails(main, count, user_id=1):
+    """Stores `count` emails for a user, each queued in the outbox as ingest would."""
+    full_address = f'user{user_id}@a.test'
+    if main.address_router.lookup(full_address) is None:
+        create_address(full_address, user_id)
+    route = main.address_router.lookup(full_address)
+    batch = [main.RoutedEmail(main.ParsedEmail(f'<m{user_id}-{i}@test>', full_address, f'sender{i}@example.org', f'Subject {i}', 'body'), *route)
+             for i in range(count)]
+    with main.get_db_conn() as conn:
+        return main._store_emails(conn, batch)
+
+def outbox_size(main):
+    with main.get_db_conn() as conn:
+        return conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+
+async def run_dispatcher(main, condition, timeout=10):
+    """Runs a dispatcher against the stub Bot API until condition(dispatcher) holds or `timeout` passes."""
+    main.db.start()
+    application = main.build_application()
+    await application.initialize()
+    dispatcher = main.NotificationDispatcher(application)
+    try:
+        await dispatcher.start()
+        deadline = time.monotonic() + timeout
+        while not await condition(dispatcher) and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+    finally:
+        dispatcher.close()
+        await application.shutdown()
+        main.db.close()
+    return dispatcher
+
+async def outbox_empty(dispatcher):
+    return dispatcher.stats()['pending'] == 0 and await bot.db.fetchone("SELECT COUNT(*) FROM outbox") == (0,)
+
+def test_flood_wait_pauses_and_then_delivers(main, bot_api):
+    bot_api.flood_every = 2 # The second sendMessage is answered with a 429
+    bot_api.retry_after = 1
+    store_emails(main, 1, user_id=1)
+    store_emails(main, 1, user_id=2)
+
+    started = time.monotonic()
+    dispatcher = asyncio.run(run_dispatcher(main, outbox_empty))
+    assert bot_api.floods == 1
+    assert sorted(message['chat_id'] for message in bot_api.sent) == [1, 2]
+    assert time.monotonic() - started >= 1 # The flood-wait held sending back
+    assert dispatcher.stats()['sent'] == 2
+    assert dispatcher.stats()['retried'] == 1
+    assert outbox_size(main) == 0
+
+def test_digest_is_split_at_notify_digest_max(main, bot_api, monkeypatch):
+    monkeypatch.setattr(main, 'NOTIFY_DIGEST_MAX', 3)
+    monkeypatch.setattr(main, 'NOTIFY_CHAT_INTERVAL', 0.1)
+    store_emails(main, 5)
+
+    dispatcher = asyncio.run(run_dispatcher(main, outbox_empty))
+    buttons = [sum(len(row) for row in message['reply_markup']['inline_keyboard']) for message in bot_api.sent]
+    assert buttons == [3, 2]
+    assert bot_api.sent[0]['text'].startswith('📬')
+    assert dispatcher.stats()['messages'] == 2
+    assert outbox_size(main) == 0
+
+def test_outbox_survives_a_restart_until_sent(main, bot_api, monkeypatch):
+    store_emails(main, 2)
+    bot_api.flood_every = 1 # Telegram refuses everything, then the bot stops
+    bot_api.retry_after = 30
+    asyncio.run(run_dispatcher(main, lambda dispatcher: asyncio.sleep(0, bot_api.floods > 0)))
+    assert bot_api.sent == []
+    assert outbox_size(main) == 2
+
+    bot_api.flood_every = 0
+    monkeypatch.setattr(main, 'db', main.Database())
+    dispatcher = asyncio.run(run_dispatcher(main, outbox_empty))
+    assert len(bot_api.sent) == 1 # Both emails, as one digest
+    assert dispatcher.stats()['sent'] == 2
+    assert outbox_size(main) == 0
@@ -0,0 +1,166 @@
+import asyncio
+import socket
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from conftest import MAILBOXES, CollectingDispatcher, create_address, deliver, fresh_state, open_session
+
+def test_idle_wakes_on_exists_sent_with_the_continuation(main, imap):
+    session = open_session(imap)
+    session.connect()
+    for number in range(3):
+        # Delivered between commands, so the server reports it in the same write as "+ idling"
+        deliver(imap, MAILBOXES[0], number, 'user@a.test')
+        started = time.monotonic()
+        assert session.wait_for_mail(5) is True
+        assert time.monotonic() - started < 1
+        session.conn.noop()
+    session.close()
+
+def test_idle_times_out_without_mail_and_releases_its_tags(main, imap):
+    session = open_session(imap)
+    session.connect()
+    for _ in range(3):
+        started = time.monotonic()
+        assert session.wait_for_mail(0.3) is False
+        assert time.monotonic() - started >= 0.3
+    assert session.conn.tagged_commands == {}
+    session.close()
+
+def test_idle_wakes_on_mail_delivered_while_idling(main, imap):
+    session = open_session(imap)
+    session.connect()
+    timer = threading.Timer(0.2, deliver, (imap, MAILBOXES[0], 1, 'user@a.test'))
+    timer.start()
+    started = time.monotonic()
+    assert session.wait_for_mail(5) is True
+    assert time.monotonic() - started < 2
+    timer.join()
+    session.close()
+
+async def ingest_once(main, imap, user=MAILBOXES[0], start_pipeline=True, timeout=None):
+    """One bot lifetime: loads state from the DB, runs the fetch stage for one mailbox, shuts down."""
+    main.db.start()
+    await main.db.read(main.address_router.load)
+    dispatcher = CollectingDispatcher()
+    pipeline = main.IngestPipeline(dispatcher)
+    if start_pipeline:
+        pipeline.start()
+    session = open_session(imap, user)
+    try:
+        await asyncio.wait_for(main.fetch_and_process_emails(pipeline, session), timeout)
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        await session.run(session.close)
+        pipeline.close()
+        main.db.close()
+    return dispatcher.emails
+
+def record_fetches(main, monkeypatch):
+    """Returns the list that every UID fetched from the server is appended to."""
+    fetched = []
+    check = main._blocking_imap_check
+    def recording_check(*args, **kwargs):
+        raw_emails, uids = check(*args, **kwargs)
+        fetched.extend(uids)
+        return raw_emails, uids
+    monkeypatch.setattr(main, '_blocking_imap_check', recording_check)
+    return fetched
+
+def seen_uids(imap, user=MAILBOXES[0]):
+    return sorted(uid for uid, (_, flags) in imap.mailboxes[user].messages.items() if '\\Seen' in flags)
+
+def checkpoint(main, imap, user=MAILBOXES[0]):
+    with main.get_db_conn() as conn:
+        return main.load_imap_checkpoint(conn, open_session(imap, user).key)
+
+def test_restart_resumes_from_the_checkpoint(main, imap, monkeypatch):
+    create_address('user@a.test', 1)
+    for number in range(7): # Two chunks of at most 5
+        deliver(imap, MAILBOXES[0], number, 'user@a.test')
+    fetched = record_fetches(main, monkeypatch)
+
+    stored = asyncio.run(ingest_once(main, imap))
+    assert len(stored) == 7
+    assert seen_uids(imap) == list(range(1, 8))
+    assert checkpoint(main, imap) == (1, 7)
+
+    # Another client marks the old mail unread; only the checkpoint keeps it from being fetched again
+    for _, flags in imap.mailboxes[MAILBOXES[0]].messages.values():
+        flags.clear()
+    for number in range(7, 9):
+        deliver(imap, MAILBOXES[0], number, 'user@a.test')
+    fetched.clear()
+    fresh_state(monkeypatch)
+    stored = asyncio.run(ingest_once(main, imap))
+    assert fetched == [8, 9]
+    # Parse workers run in parallel, so emails of one chunk may be stored in any order
+    assert sorted(email.subject.split(':')[0] for email in stored) == ['Benchmark message 7', 'Benchmark message 8']
+    assert checkpoint(main, imap) == (1, 9)
+
+def test_mail_not_stored_before_a_crash_is_fetched_again(main, imap, monkeypatch):
+    create_address('user@a.test', 1)
+    for number in range(3):
+        deliver(imap, MAILBOXES[0], number, 'user@a.test')
+
+    # Fetched and queued, but the process dies before the writer commits anything
+    asyncio.run(ingest_once(main, imap, start_pipeline=False, timeout=1))
+    assert seen_uids(imap) == []
+    assert checkpoint(main, imap) is None
+
+    fresh_state(monkeypatch)
+    stored = asyncio.run(ingest_once(main, imap))
+    assert len(stored) == 3
+    assert seen_uids(imap) == [1, 2, 3]
+    assert checkpoint(main, imap) == (1, 3)
+
+def test_unresponsive_server_fails_instead_of_hanging(main, monkeypatch):
+    monkeypatch.setattr(main, 'IMAP_SOCKET_TIMEOUT', 0.3)
+    # The kernel completes the handshake, but nothing ever answers, like a half-open connection
+    with socket.create_server(('127.0.0.1', 0)) as silent:
+        session = main.ImapSession('127.0.0.1', 'user', 'secret', port=silent.getsockname()[1], ssl=False)
+        started = time.monotonic()
+        with pytest.raises(OSError):
+            session.connect()
+        assert time.monotonic() - started < 2
+
+def test_chunk_that_failed_to_store_is_fetched_again(main, imap, monkeypatch):
+    create_address('user@a.test', 1)
+    for number in range(2):
+        deliver(imap, MAILBOXES[0], number, 'user@a.test')
+
+    store_emails = main._store_emails
+    def locked(conn, batch):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(main, '_store_emails', locked)
+    with pytest.raises(RuntimeError, match='not stored'):
+        asyncio.run(ingest_once(main, imap))
+    assert seen_uids(imap) == []
+    assert checkpoint(main, imap) is None
+
+    monkeypatch.setattr(main, '_store_emails', store_emails)
+    fresh_state(monkeypatch)
+    stored = asyncio.run(ingest_once(main, imap))
+    assert len(stored) == 2
+    assert seen_uids(imap) == [1, 2]
+    assert checkpoint(main, imap) == (1, 2)
+
+def test_failed_write_is_not_taken_for_a_duplicate_on_retry(main, imap, monkeypatch):
+    create_address('user@a.test', 1)
+    deliver(imap, MAILBOXES[0], 0, 'user@a.test')
+
+    store_emails = main._store_emails
+    def locked(conn, batch):
+        raise sqlite3.OperationalError('database is locked')
+    monkeypatch.setattr(main, '_store_emails', locked)
+    with pytest.raises(RuntimeError, match='not stored'):
+        asyncio.run(ingest_once(main, imap))
+
+    # Same process, so the Message-ID LRU is still the one the failed attempt used
+    monkeypatch.setattr(main, '_store_emails', store_emails)
+    monkeypatch.setattr(main, 'db', main.Database())
+    assert len(asyncio.run(ingest_once(main, imap))) == 1
@@ -0,0 +1,47 @@
+import asyncio
+
+from conftest import MAILBOXES, CollectingDispatcher, create_address, deliver, open_session
+
+CHECKPOINTS = "SELECT mailbox, last_uid FROM imap_checkpoints ORDER BY mailbox"
+
+def test_mailboxes_are_fetched_in_parallel_and_routed_by_recipient(main, imap):
+    create_address('alice@a.test', 1)
+    create_address('bob@b.test', 2)
+    # One mailbox per domain; mail for an address nobody owns is dropped
+    deliver(imap, MAILBOXES[0], 0, 'alice@a.test')
+    deliver(imap, MAILBOXES[0], 1, 'nobody@a.test')
+    deliver(imap, MAILBOXES[1], 2, 'bob@b.test')
+
+    async def scenario():
+        main.db.start()
+        dispatcher = CollectingDispatcher()
+        pipeline = main.IngestPipeline(dispatcher)
+        pipeline.start()
+        sessions = [open_session(imap, user) for user in MAILBOXES]
+        workers = [asyncio.create_task(main.background_tasks_loop(pipeline, session)) for session in sessions]
+
+        async def acknowledged():
+            expected = [(sessions[0].key, 2), (sessions[1].key, 2)]
+            while await main.db.fetchall(CHECKPOINTS) != expected:
+                await asyncio.sleep(0.01)
+        try:
+            await dispatcher.wait_for(2)
+            # Arrives while both workers idle; routing follows the recipient, not the mailbox
+            deliver(imap, MAILBOXES[1], 3, 'alice@a.test')
+            await dispatcher.wait_for(3)
+            # The writer notifies before the chunk is flagged and checkpointed
+            await asyncio.wait_for(acknowledged(), 10)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            for session in sessions:
+                session.stop()
+                await session.run(session.close)
+            pipeline.close()
+            main.db.close()
+        return dispatcher.emails, pipeline.metrics['parse'].dropped
+
+    emails, dropped = asyncio.run(scenario())
+    routed = sorted((email.subject.split(':')[0], email.user_id) for email in emails)
+    assert routed == [('Benchmark message 0', 1), ('Benchmark message 2', 2), ('Benchmark message 3', 1)]
+    assert dropped == 1